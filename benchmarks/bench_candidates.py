@@ -0,0 +1,85 @@
+"""
+Benchmarks get_next_chord with the candidates get_nearest_note gives each
+voice against full_register (every voicing from get_register_candidates),
+reporting the candidates considered and the time per chord, and the mean cost
+(evaluate_progression) of the chords chosen, e.g.
+
+	python3 benchmarks/bench_candidates.py --progressions 40
+"""
+
+from __future__ import print_function
+
+import argparse
+import random
+import sys
+import time
+
+from bench_voiceleading import KEYS, REPO
+
+sys.path.insert(0, REPO)
+
+import voiceleading
+
+def measure(progressions, full_register):
+	"""
+	Voices each progression in each of KEYS, returning the time and mean cost
+	per chord, the candidates per chord, and the chords with no candidates in
+	the register (voiced by get_nearest_note instead).
+	"""
+	candidates = 0
+	fallbacks = 0
+	chords = 0
+	cost = 0.0
+	elapsed = 0.0
+	for progression in progressions:
+		for key in KEYS:
+			last_chord = voiceleading.get_first_chord(key, True)
+			for numeral in progression[1:]:
+				quality = voiceleading.ROMAN_NUMERAL_TO_QUALITY[numeral][0]
+				root_name = voiceleading.get_root_name(numeral, key)
+				# Counted outside the timing, from the same current chord.
+				if full_register:
+					count = len(voiceleading.get_register_candidates(last_chord,
+						quality, root_name))
+					fallbacks += count == 0
+				elif len(voiceleading.get_chord_notes(quality,
+					voiceleading.Note(root_name, 4))) == 4:
+					count = 6
+				else:
+					count = 18
+				candidates += count
+
+				start = time.time()
+				next_chord = voiceleading.get_next_chord(last_chord, quality,
+					root_name, key, full_register=full_register)
+				elapsed += time.time() - start
+				cost += voiceleading.evaluate_progression(last_chord,
+					next_chord, key)
+				chords += 1
+				last_chord = next_chord
+	return {"time": elapsed / chords, "cost": cost / chords,
+		"candidates": candidates / float(chords), "fallbacks": fallbacks}
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+	parser.add_argument("--progressions", type=int, default=40,
+		help="random progressions to voice in each key")
+	parser.add_argument("--seed", type=int, default=0)
+	args = parser.parse_args()
+
+	rng = random.Random(args.seed)
+	progressions = [voiceleading.get_random_progression(
+		voiceleading.MAJOR_MARKOV_PROGRESSION_MODEL, rng)
+		for count in range(args.progressions)]
+
+	print("%-16s %12s %12s %10s %10s" % ("", "candidates", "per chord",
+		"cost", "fallbacks"))
+	for label, full_register in [("nearest note", False),
+		("full register", True)]:
+		results = measure(progressions, full_register)
+		print("%-16s %12.1f %9.3f ms %10.4f %10d" % (label,
+			results["candidates"], results["time"] * 1000, results["cost"],
+			results["fallbacks"]))
+
+if __name__ == "__main__":
+	main()
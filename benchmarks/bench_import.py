@@ -0,0 +1,100 @@
+"""
+Benchmarks importing voiceleading in a fresh interpreter, as short-lived
+worker processes do, and reports whether the import loaded midiutil, e.g.
+
+	python3 benchmarks/bench_import.py --revision HEAD~1
+
+With --revision, the given revision (checked out with git archive into a
+temporary directory) is timed as well, for comparison, on the interpreter
+given with --python (by default this one). Revisions before the port to
+Python 3 need a Python 2 interpreter, e.g.
+
+	python3 benchmarks/bench_import.py --revision HEAD~30 --python python2.7
+
+A revision that fails to import is reported as such.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_voiceleading import REPO, checkout
+
+# Run in each new interpreter. The import is timed on its own, and the whole
+# process from the outside.
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.time()
+import voiceleading
+print(json.dumps({"import": time.time() - start,
+	"midiutil": "midiutil.MidiFile3" in sys.modules}))
+"""
+
+def measure(python, source, repeat):
+	"""
+	Imports voiceleading from source in repeat new processes, returning the
+	best import and process times, and whether midiutil was imported, or
+	None if the import fails.
+	"""
+	# Older revisions write MIDI files on import, so run somewhere disposable.
+	output = tempfile.mkdtemp()
+	environment = dict(os.environ, PYTHONPATH=source)
+	results = {"import": None, "process": None}
+	try:
+		for count in range(repeat):
+			start = time.time()
+			try:
+				lines = subprocess.check_output([python, "-c", IMPORT_SCRIPT],
+					cwd=output, env=environment,
+					stderr=subprocess.STDOUT).decode("ascii").splitlines()
+			except subprocess.CalledProcessError as error:
+				print(error.output.decode("ascii", "replace").rstrip(),
+					file=sys.stderr)
+				return None
+			elapsed = time.time() - start
+			run = json.loads(lines[-1])
+			run["process"] = elapsed
+			for name in ("import", "process"):
+				if results[name] is None or run[name] < results[name]:
+					results[name] = run[name]
+			results["midiutil"] = run["midiutil"]
+	finally:
+		shutil.rmtree(output)
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+	parser.add_argument("--revision",
+		help="a revision to compare the working tree with")
+	parser.add_argument("--python", default=sys.executable,
+		help="the interpreter to time the revision with")
+	parser.add_argument("--repeat", type=int, default=20)
+	args = parser.parse_args()
+
+	runs = [("working tree", measure(sys.executable, REPO, args.repeat))]
+	if args.revision:
+		source = checkout(args.revision)
+		try:
+			runs.append((args.revision, measure(args.python, source,
+				args.repeat)))
+		finally:
+			shutil.rmtree(source)
+
+	print("%-16s %12s %12s  %s" % ("", "import", "process", "midiutil"))
+	for label, results in runs:
+		if results is None:
+			print("%-16s %s" % (label, "does not import (see above)"))
+		else:
+			print("%-16s %9.2f ms %9.2f ms  %s" % (label,
+				results["import"] * 1000, results["process"] * 1000,
+				results["midiutil"]))
+
+if __name__ == "__main__":
+	main()
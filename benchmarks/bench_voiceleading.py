@@ -0,0 +1,142 @@
+"""
+Benchmarks voice leading (get_chord_progression) and MIDI export
+(create_midi_from_progression) on the current interpreter, and optionally on
+a legacy interpreter running the last Python 2 revision of the code, e.g.
+
+	python3 benchmarks/bench_voiceleading.py --legacy-python python2.7
+
+The legacy revision defaults to the first commit of the repository. It is
+checked out (with git archive) into a temporary directory, so the working tree
+is left alone. This file has to run on Python 2 as well, as it times the
+legacy interpreter by running itself there.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Progressions in the major key, drawn from the Markov model in voiceleading,
+# so that both revisions do the same work.
+PROGRESSIONS = [
+	["I", "viidim6", "I6", "vi", "ii", "IV6", "ii6", "IV", "V42", "I6", "V",
+		"vi", "ii", "IV", "I64", "V7", "I"],
+	["I", "IV6", "I6", "ii6", "V65", "vi", "ii6", "I64", "V7", "I"],
+	["I", "V42", "I6", "IV", "V7", "vi", "ii", "IV", "I"],
+	["I", "ii6", "V43", "I6", "vi", "ii6", "V", "I"]]
+KEYS = ["C", "F", "G", "D", "Bb", "A", "Eb"]
+
+def time_call(function, repeat):
+	"""
+	Returns the best time, in seconds, of repeat calls of function.
+	"""
+	best = None
+	for count in range(repeat):
+		start = time.time()
+		function()
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+def measure(source, repeat):
+	"""
+	Times the workload against the voiceleading module in source, returning a
+	dictionary of the best times of one pass over PROGRESSIONS and KEYS.
+	"""
+	output = tempfile.mkdtemp()
+	os.chdir(output)
+	sys.path.insert(0, source)
+	stdout = sys.stdout
+	try:
+		# Older revisions generate (and print) a progression on import.
+		sys.stdout = open(os.devnull, "w")
+		import voiceleading
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+
+	def progressions():
+		random.seed(0)
+		return [voiceleading.get_chord_progression(progression, key, True)
+			for progression in PROGRESSIONS for key in KEYS]
+
+	chords = progressions()
+
+	def export():
+		for progression in chords:
+			voiceleading.create_midi_from_progression(progression)
+
+	results = {"get_chord_progression": time_call(progressions, repeat),
+		"create_midi_from_progression": time_call(export, repeat)}
+	shutil.rmtree(output)
+	return results
+
+def checkout(revision):
+	"""
+	Extracts the given revision of the repository to a temporary directory,
+	returning its path.
+	"""
+	directory = tempfile.mkdtemp()
+	archive = os.path.join(directory, "source.tar")
+	with open(archive, "wb") as tar:
+		subprocess.check_call(["git", "archive", revision], cwd=REPO, stdout=tar)
+	with tarfile.open(archive) as tar:
+		tar.extractall(directory)
+	return directory
+
+def run_worker(python, source, repeat):
+	"""
+	Runs measure in a new process with the given interpreter.
+	"""
+	output = subprocess.check_output([python, os.path.abspath(__file__),
+		"--worker", source, "--repeat", str(repeat)])
+	return json.loads(output.decode("ascii").splitlines()[-1])
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+	parser.add_argument("--legacy-python",
+		help="the interpreter to time the legacy revision with")
+	parser.add_argument("--legacy-revision",
+		help="the revision to time on the legacy interpreter")
+	parser.add_argument("--repeat", type=int, default=5)
+	parser.add_argument("--worker", help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.worker:
+		print(json.dumps(measure(args.worker, args.repeat)))
+		return
+
+	runs = [("Python %d.%d" % sys.version_info[:2],
+		run_worker(sys.executable, REPO, args.repeat))]
+	if args.legacy_python:
+		revision = args.legacy_revision
+		if revision is None:
+			revision = subprocess.check_output(["git", "rev-list",
+				"--max-parents=0", "HEAD"], cwd=REPO).decode("ascii").split()[0]
+		source = checkout(revision)
+		try:
+			runs.append((os.path.basename(args.legacy_python) + " @ " + revision[:10],
+				run_worker(args.legacy_python, source, args.repeat)))
+		finally:
+			shutil.rmtree(source)
+
+	current = runs[0][1]
+	for name in sorted(current):
+		print(name)
+		for label, results in runs:
+			print("  %-24s %9.2f ms  %5.2fx" % (label, results[name] * 1000,
+				results[name] / current[name]))
+
+if __name__ == "__main__":
+	main()
@@ -10,7 +10,14 @@
 #              software is distributed.
 #-----------------------------------------------------------------------------
 
-import struct,  sys,  math
+import struct,  sys,  math,  mmap,  array,  heapq,  operator,  concurrent.futures
+
+# NumPy is optional. If it is available it is used to compute the event times of
+# the tracks, and MIDIReader.columns needs it.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # TICKSPERBEAT is the number of "ticks" (time measurement in the MIDI file) that
 # corresponds to one beat. This number is somewhat arbitrary, but should be chosen
@@ -21,6 +28,161 @@ TICKSPERBEAT = 960
 controllerEventTypes = {
                         'pan' : 0x0a
                         }
+
+# Modes of the key signature meta-event.
+
+MAJOR = 0
+MINOR = 1
+
+# Encoded byte templates, shared by every file written. The MThd header is keyed
+# by (format, number of tracks, ticks per beat), and track preludes (see
+# MIDIFile.setTrackPrelude) by (track name, tempo, ticks per beat).
+
+headerTemplates = {}
+preludeTemplates = {}
+
+# Packing formats shared by the event encoders.
+
+oneByte = struct.Struct('>B')
+twoBytes = struct.Struct('>BB')
+fourBytes = struct.Struct('>BBBB')
+
+class MIDIEventType:
+    '''
+    One of the MIDI events that an event type is written as.
+    
+    type is the type of the MIDIEvent, and ord ranks it among events at the
+    same time (lower ords come first). encoder is a function of the MIDIEvent
+    and the track's compact flag, returning a (status, data) pair: for a
+    channel event, status is its status byte and data the bytes that follow it,
+    so that the status byte can be left out under running status; for meta and
+    SysEx events, status is None and data is the whole event. If offset is
+    given, it names the attribute (in beats) by which the event follows the
+    time of the event it was created from, as a NoteOff follows its NoteOn by
+    the note's duration.
+    '''
+    def __init__(self, type, ord, encoder, offset=None):
+        self.type = type
+        self.ord = ord
+        self.encoder = encoder
+        self.offset = offset
+
+class EventType:
+    '''
+    An event type, as registered with registerEventType.
+    
+    name is the type of the GenericEvent, fields the attributes other than the
+    time that make two events of the type the same (see GenericEvent.__eq__),
+    and parts the list of MIDIEventTypes that each event is written as.
+    '''
+    def __init__(self, name, fields, parts):
+        self.name = name
+        self.fields = tuple(fields)
+        self.parts = parts
+        if self.fields:
+            self.identity = operator.attrgetter(*self.fields)
+        else:
+            self.identity = lambda event: ()
+
+# The registered event types, keyed by the type of the GenericEvent, and the
+# encoders of their MIDI events, keyed by the type of the MIDIEvent.
+
+eventTypes = {}
+eventEncoders = {}
+
+def registerEventType(name, fields, parts):
+    '''
+    Register an event type.
+    
+    Use:
+        registerEventType(name, fields, parts)
+        
+    Arguments:
+        name: The type of the GenericEvent subclass.
+        fields: The attributes of the event, besides its time, which are
+            compared to find duplicates.
+        parts: A list of MIDIEventTypes, one for each MIDI event written.
+        
+    The attributes of the event are copied to each of its MIDIEvents, so
+    the encoders can use them. This is all that is needed to add an event type:
+    define the GenericEvent subclass and an accessor that adds it to a track,
+    and register it. Register the type when your module is imported, so that
+    it is also known to the worker processes of MIDIFile.close.
+    '''
+    eventTypes[name] = EventType(name, fields, parts)
+    for part in parts:
+        eventEncoders[part.type] = part.encoder
+
+def encodeNoteOn(event, compact):
+    return 0x90 | event.channel, twoBytes.pack(event.pitch, event.volume)
+
+def encodeNoteOff(event, compact):
+    # A NoteOn with a velocity of zero is equivalent to a NoteOff, and shares its
+    # status byte with the NoteOn events around it.
+    if compact:
+        return 0x90 | event.channel, twoBytes.pack(event.pitch, 0)
+    return 0x80 | event.channel, twoBytes.pack(event.pitch, event.volume)
+
+def encodeTempo(event, compact):
+    # The tempo is three bytes long, so the MSB is discarded.
+    return None, struct.pack('>BBB', 0xFF, 0x51, 0x03) + \
+        struct.pack('>L', event.tempo)[1:4]
+
+def encodeProgramChange(event, compact):
+    return 0xC0 | event.channel, oneByte.pack(event.programNumber)
+
+def encodeTrackName(event, compact):
+    name = event.trackName.encode()
+    return None, twoBytes.pack(0xFF, 0x03) + bytes(writeVarLength(len(name))) + name
+
+def encodeTimeSignature(event, compact):
+    # The denominator is written as a power of two.
+    return None, struct.pack('>BBBBBBB', 0xFF, 0x58, 0x04, event.numerator, \
+        int(event.denominator).bit_length() - 1, event.clocksPerTick, \
+        event.notesPerQuarter)
+
+def encodeKeySignature(event, compact):
+    # The number of accidentals is signed: negative numbers count flats.
+    return None, struct.pack('>BBBbB', 0xFF, 0x59, 0x02, event.accidentals, \
+        event.mode)
+
+def encodeControllerEvent(event, compact):
+    return 0xB0 | event.channel, twoBytes.pack(event.eventType, event.parameter1)
+
+def encodeSysEx(event, compact):
+    # The length includes the manufacturer ID and the closing F7.
+    return None, oneByte.pack(0xF0) + \
+        bytes(writeVarLength(len(event.payload) + 2)) + \
+        oneByte.pack(event.manID) + event.payload + oneByte.pack(0xF7)
+
+def encodeUniversalSysEx(event, compact):
+    if event.realTime:
+        realTime = 0x7F
+    else:
+        realTime = 0x7E
+    return None, oneByte.pack(0xF0) + \
+        bytes(writeVarLength(len(event.payload) + 5)) + \
+        fourBytes.pack(realTime, event.sysExChannel, event.code, event.subcode) + \
+        event.payload + oneByte.pack(0xF7)
+
+registerEventType('note', ('pitch', 'channel'), \
+    [MIDIEventType('NoteOn', 3, encodeNoteOn), \
+     MIDIEventType('NoteOff', 2, encodeNoteOff, 'duration')])
+registerEventType('tempo', ('tempo',), [MIDIEventType('Tempo', 3, encodeTempo)])
+registerEventType('programChange', ('programNumber', 'channel'), \
+    [MIDIEventType('ProgramChange', 1, encodeProgramChange)])
+registerEventType('trackName', ('trackName',), \
+    [MIDIEventType('TrackName', 0, encodeTrackName)])
+registerEventType('timeSignature', ('numerator', 'denominator'), \
+    [MIDIEventType('TimeSignature', 0, encodeTimeSignature)])
+registerEventType('keySignature', ('accidentals', 'mode'), \
+    [MIDIEventType('KeySignature', 1, encodeKeySignature)])
+registerEventType('controllerEvent', ('parameter1', 'channel', 'eventType'), \
+    [MIDIEventType('ControllerEvent', 1, encodeControllerEvent)])
+registerEventType('SysEx', ('manID',), [MIDIEventType('SysEx', 1, encodeSysEx)])
+registerEventType('UniversalSysEx', ('code', 'subcode', 'sysExChannel'), \
+    [MIDIEventType('UniversalSysEx', 1, encodeUniversalSysEx)])
+
 class MIDIEvent:
     '''
     The class to contain the MIDI Event (placed on MIDIEventList.
@@ -75,49 +237,16 @@ class GenericEvent():
         we rely on the fact that the classes are hashable, and must therefore have an 
         equality operator (__hash__() and __eq__() must both be defined).
         
-        This is the most embarrassing portion of the code, and anyone who knows about OO
-        programming would find this almost unbelievable. Here we have a base class that
-        knows specifics about derived classes, thus breaking the very spirit of 
-        OO programming.
-        
-        I suppose I should go back and restructure the code, perhaps removing the derived
-        classes altogether. At some point perhaps I will.
+        Two events are equal if they have the same time and type, and the same values
+        of the fields registered for their type (see registerEventType).
         '''
         if self.time != other.time or self.type != other.type:
             return False
             
-        # What follows is code that encodes the concept of equality for each derived 
-        # class. Believe it f you dare.
-        
-        if self.type == 'note':
-            if self.pitch != other.pitch or self.channel != other.channel:
-                return False
-        if self.type == 'tempo':
-            if self.tempo != other.tempo:
-                return False
-        if self.type == 'programChange':
-            if self.programNumber != other.programNumber or self.channel != other.channel:
-                return False
-        if self.type == 'trackName':
-            if self.trackName != other.trackName:
-                return False
-        if self.type == 'controllerEvent':
-            if self.parameter1 != other.parameter1 or \
-                self.channel != other.channel or \
-                self.eventType != other.eventType:
-                return False
-                
-        if self.type == 'SysEx':
-            if self.manID != other.manID:
-                return False
-                
-        if self.type == 'UniversalSysEx':
-            if self.code != other.code or\
-                self.subcode != other.subcode or \
-                self.sysExChannel != other.sysExChannel:
-                return False
-                
-        return True
+        eventType = eventTypes.get(self.type)
+        if eventType is None:
+            return True
+        return eventType.identity(self) == eventType.identity(other)
         
     def __hash__(self):
         '''
@@ -230,77 +359,134 @@ class MIDITrack:
             self.type = 'trackName'
             self.trackName = trackName
 
+    class timeSignature(GenericEvent):
+        '''A class that encapsulates a time signature meta-event.
+        '''
+        
+        def __init__(self,  time,  numerator,  denominator,  clocksPerTick,  \
+            notesPerQuarter):
+            GenericEvent.__init__(self, time,)
+            self.type = 'timeSignature'
+            self.numerator = numerator
+            self.denominator = denominator
+            self.clocksPerTick = clocksPerTick
+            self.notesPerQuarter = notesPerQuarter
+
+    class keySignature(GenericEvent):
+        '''A class that encapsulates a key signature meta-event.
+        '''
+        
+        def __init__(self,  time,  accidentals,  mode):
+            GenericEvent.__init__(self, time,)
+            self.type = 'keySignature'
+            self.accidentals = accidentals
+            self.mode = mode
+
             
-    def __init__(self, removeDuplicates,  deinterleave):
+    def __init__(self, removeDuplicates,  deinterleave,  compact=False):
         '''Initialize the MIDITrack object.
         '''
         self.headerString = struct.pack('cccc',b'M',b'T',b'r',b'k')
         self.dataLength = 0 # Is calculated after the data is in place
         self.MIDIdata = b""
-        self.closed = False
         self.eventList = []
         self.MIDIEventList = []
+        self.eventTimes = []        # Absolute times of the MIDIEventList, in whole ticks
         self.remdep = removeDuplicates
         self.deinterleave = deinterleave
+        self.compact = compact
+        
+        # The track is dirty when events have been added since the MIDIEventList was
+        # last built. encodedOrigin is the origin that MIDIdata was encoded against,
+        # or None if MIDIdata is out of date.
+        self.dirty = True
+        self.encodedOrigin = None
+        
+        # Pre-encoded events written at the start of the track (see setPrelude).
+        self.prelude = b""
+        
+    def addEvent(self, event):
+        '''
+        Add an event to the eventList, marking the track as changed.
+        '''
+        self.eventList.append(event)
+        self.dirty = True
+        self.encodedOrigin = None
         
     def addNoteByNumber(self,channel, pitch,time,duration,volume):
         '''Add a note by chromatic MIDI number
         '''
-        self.eventList.append(MIDITrack.note(channel, pitch,time,duration,volume))
+        self.addEvent(MIDITrack.note(channel, pitch,time,duration,volume))
         
     def addControllerEvent(self,channel,time,eventType, paramerter1):
         '''
         Add a controller event.
         '''
         
-        self.eventList.append(MIDITrack.ControllerEvent(channel,time,eventType, \
+        self.addEvent(MIDITrack.ControllerEvent(channel,time,eventType, \
                                              paramerter1))
         
     def addTempo(self,time,tempo):
         '''
         Add a tempo change (or set) event.
         '''
-        self.eventList.append(MIDITrack.tempo(time,tempo))
+        self.addEvent(MIDITrack.tempo(time,tempo))
         
     def addSysEx(self,time,manID, payload):
         '''
         Add a SysEx event.
         '''
-        self.eventList.append(MIDITrack.SysExEvent(time, manID,  payload))
+        self.addEvent(MIDITrack.SysExEvent(time, manID,  payload))
         
     def addUniversalSysEx(self,time,code, subcode, payload,  sysExChannel=0x7F,  \
         realTime=False):
         '''
         Add a Universal SysEx event.
         '''
-        self.eventList.append(MIDITrack.UniversalSysExEvent(time, realTime,  \
+        self.addEvent(MIDITrack.UniversalSysExEvent(time, realTime,  \
             sysExChannel,  code,  subcode, payload))
         
     def addProgramChange(self,channel, time, program):
         '''
         Add a program change event.
         '''
-        self.eventList.append(MIDITrack.programChange(channel, time, program))
+        self.addEvent(MIDITrack.programChange(channel, time, program))
         
     def addTrackName(self,time,trackName):
         '''
         Add a track name event.
         '''
-        self.eventList.append(MIDITrack.trackName(time,trackName))
+        self.addEvent(MIDITrack.trackName(time,trackName))
+        
+    def addTimeSignature(self,time,numerator,denominator,clocksPerTick, \
+        notesPerQuarter):
+        '''
+        Add a time signature event.
+        '''
+        self.addEvent(MIDITrack.timeSignature(time,numerator,denominator, \
+            clocksPerTick,notesPerQuarter))
+        
+    def addKeySignature(self,time,accidentals,mode):
+        '''
+        Add a key signature event.
+        '''
+        self.addEvent(MIDITrack.keySignature(time,accidentals,mode))
+        
+    def setPrelude(self,trackName,tempo):
+        '''
+        Set the track name and tempo written at the start of the track.
+        '''
+        self.prelude = encodeTrackPrelude(trackName,tempo)
+        self.encodedOrigin = None
         
     def changeNoteTuning(self,  tunings,   sysExChannel=0x7F,  realTime=False,  \
-        tuningProgam=0):
+        tuningProgam=0,  time=0):
         '''Change the tuning of MIDI notes
         '''
-        payload = struct.pack('>B',  tuningProgam)
-        payload = payload + struct.pack('>B',  len(tunings))
-        for (noteNumber,  frequency) in tunings:
-            payload = payload + struct.pack('>B',  noteNumber)
-            MIDIFreqency = frequencyTransform(frequency)
-            for byte in MIDIFreqency:
-                payload = payload + struct.pack('>B',  byte)
+        payload = struct.pack('>BB',  tuningProgam,  len(tunings)) + \
+            encodeNoteTunings(tunings)
                 
-        self.eventList.append(MIDITrack.UniversalSysExEvent(0, realTime,  sysExChannel,\
+        self.addEvent(MIDITrack.UniversalSysExEvent(time, realTime,  sysExChannel,\
             8,  2, payload))
     
     def processEventList(self):
@@ -311,87 +497,24 @@ class MIDITrack:
         list are created.
         '''
         
-        # Loop over all items in the eventList
+        # Loop over all items in the eventList, creating the MIDI events registered
+        # for each item's type.
         
         for thing in self.eventList:
-            if thing.type == 'note':
-                event = MIDIEvent()
-                event.type = "NoteOn"
-                event.time = thing.time * TICKSPERBEAT
-                event.pitch = thing.pitch
-                event.volume = thing.volume
-                event.channel = thing.channel
-                event.ord = 3
-                self.MIDIEventList.append(event)
-
-                event = MIDIEvent()
-                event.type = "NoteOff"
-                event.time = (thing.time + thing.duration) * TICKSPERBEAT
-                event.pitch = thing.pitch
-                event.volume = thing.volume
-                event.channel = thing.channel
-                event.ord = 2
-                self.MIDIEventList.append(event)
-
-            elif thing.type == 'tempo':
-                event = MIDIEvent()
-                event.type = "Tempo"
-                event.time = thing.time * TICKSPERBEAT
-                event.tempo = thing.tempo
-                event.ord = 3
-                self.MIDIEventList.append(event)
-
-            elif thing.type == 'programChange':
-                event = MIDIEvent()
-                event.type = "ProgramChange"
-                event.time = thing.time * TICKSPERBEAT
-                event.programNumber = thing.programNumber
-                event.channel = thing.channel
-                event.ord = 1
-                self.MIDIEventList.append(event)
-
-            elif thing.type == 'trackName':
-                event = MIDIEvent()
-                event.type = "TrackName"
-                event.time = thing.time * TICKSPERBEAT
-                event.trackName = thing.trackName
-                event.ord = 0
-                self.MIDIEventList.append(event)
-
-            elif thing.type == 'controllerEvent':
-                event = MIDIEvent()
-                event.type = "ControllerEvent"
-                event.time = thing.time * TICKSPERBEAT
-                event.eventType = thing.eventType
-                event.channel = thing.channel
-                event.paramerter1 = thing.parameter1
-                event.ord = 1
-                self.MIDIEventList.append(event)
-
-            elif thing.type == 'SysEx':
-                event = MIDIEvent()
-                event.type = "SysEx"
-                event.time = thing.time * TICKSPERBEAT
-                event.manID = thing.manID
-                event.payload = thing.payload
-                event.ord = 1
-                self.MIDIEventList.append(event)
-
-            elif thing.type == 'UniversalSysEx':
-                event = MIDIEvent()
-                event.type = "UniversalSysEx"
-                event.realTime = thing.realTime
-                event.sysExChannel = thing.sysExChannel
-                event.time = thing.time * TICKSPERBEAT
-                event.code = thing.code
-                event.subcode = thing.subcode
-                event.payload = thing.payload
-                event.ord = 1
-                self.MIDIEventList.append(event)
-
-            else:
+            eventType = eventTypes.get(thing.type)
+            if eventType is None:
                 print ("Error in MIDITrack: Unknown event type")
                 sys.exit(2)
+            for part in eventType.parts:
+                event = MIDIEvent()
+                event.__dict__.update(thing.__dict__)
+                event.type = part.type
+                if part.offset is None:
+                    event.time = thing.time * TICKSPERBEAT
+                else:
+                    event.time = (thing.time + getattr(thing, part.offset)) * TICKSPERBEAT
+                event.ord = part.ord
+                self.MIDIEventList.append(event)
             
         # Assumptions in the code expect the list to be time-sorted.
         # self.MIDIEventList.sort(lambda x, y: x.time - y.time)
@@ -431,26 +554,46 @@ class MIDITrack:
         prepare the actual data stream for writing. Duplicate events are
         removed from the eventList, and the MIDIEventList is created.
         
+        The MIDIEventList is only rebuilt if events have been added since the
+        last time the track was closed. The absolute time of each event is kept
+        in eventTimes, as the events' own times are made relative when the track
+        is encoded.
+        
         Called by the parent MIDIFile object.
         '''
 
-        if self.closed == True:
+        if not self.dirty:
             return
-        self.closed = True
+        self.dirty = False
         
         if self.remdep:
             self.removeDuplicates()
             
 
+        self.MIDIEventList = []
         self.processEventList()
         
+        # We want things like program changes to come before notes when they are at the
+        # same time, so we sort the MIDI events by their ordinality
+        self.MIDIEventList.sort()
+        
+        # The times are rounded to whole ticks here, once, so that the relative times
+        # computed from them are exact and need no further correction for round-off.
+        if numpy is not None:
+            self.eventTimes = numpy.floor(numpy.array([event.time for event in \
+                self.MIDIEventList], dtype=numpy.float64) + 0.5).astype(numpy.int64)
+        else:
+            self.eventTimes = [int(math.floor(event.time + 0.5)) for event in \
+                               self.MIDIEventList]
+        
     def writeMIDIStream(self):
         '''
         Write the meta data and note data to the packed MIDI stream.
         '''
 
-        #Process the events in the eventList
+        #Process the events in the eventList, after the prelude (if any)
 
+        self.MIDIdata = self.prelude
         self.writeEventsToStream()
 
         # Write MIDI close event.
@@ -466,128 +609,32 @@ class MIDITrack:
         '''
         Write the events in MIDIEvents to the MIDI stream.
         '''
-        preciseTime = 0.0                   # Actual time of event, ignoring round-off
-        actualTime = 0.0                    # Time as written to midi stream, include round-off
-        for event in self.MIDIEventList:
-
-            preciseTime = preciseTime + event.time
-
-            # Convert the time to variable length and back, to see how much
-            # error is introduced
-
-            testBuffer = bytes()
-            varTime = writeVarLength(event.time)
-            for timeByte in varTime:
-                testBuffer = testBuffer + struct.pack('>B',timeByte)
-            (roundedVal,discard) = readVarLength(0,testBuffer)
-            roundedTime = actualTime + roundedVal
-            # print "Rounded, Precise: %15.10f %15.10f" % (roundedTime, preciseTime)
+        # The event times are whole ticks (see closeTrack and adjustTime), so they are
+        # written as they are, with no round-off to correct for. Each event is encoded
+        # by the encoder registered for its type (see registerEventType).
 
-            # Calculate the delta between the two and apply it to the event time.
+        # In compact mode channel events use running status: the status byte is
+        # left out when it is the same as that of the previous event. It stays
+        # None otherwise, so that every status byte is written. Meta and SysEx
+        # events (which have no status of their own) cancel running status.
 
-            delta = preciseTime - roundedTime
-            event.time = event.time + delta
+        runningStatus = None
+        compact = self.compact
+        chunks = [self.MIDIdata]
 
-            # Now update the actualTime value, using the updated event time.
-
-            testBuffer = bytes()
-            varTime = writeVarLength(event.time)
-            for timeByte in varTime:
-                testBuffer = testBuffer + struct.pack('>B',timeByte)
-            (roundedVal,discard) = readVarLength(0,testBuffer)
-            actualTime = actualTime + roundedVal
-        
         for event in self.MIDIEventList:
-            if event.type == "NoteOn":
-                code = 0x9 << 4 | event.channel
-                varTime = writeVarLength(event.time)
-                for timeByte in varTime:
-                    self.MIDIdata = self.MIDIdata + struct.pack('>B',timeByte)
-                self.MIDIdata = self.MIDIdata + struct.pack('>B',code)
-                self.MIDIdata = self.MIDIdata + struct.pack('>B',event.pitch)
-                self.MIDIdata = self.MIDIdata + struct.pack('>B',event.volume)
-            elif event.type == "NoteOff":
-                code = 0x8 << 4 | event.channel
-                varTime = writeVarLength(event.time)
-                for timeByte in varTime:
-                    self.MIDIdata = self.MIDIdata + struct.pack('>B',timeByte)
-                self.MIDIdata = self.MIDIdata + struct.pack('>B',code)
-                self.MIDIdata = self.MIDIdata + struct.pack('>B',event.pitch)
-                self.MIDIdata = self.MIDIdata + struct.pack('>B',event.volume)
-            elif event.type == "Tempo":
-                code = 0xFF
-                subcode = 0x51
-                fourbite = struct.pack('>L', event.tempo)
-                threebite = fourbite[1:4]       # Just discard the MSB
-                varTime = writeVarLength(event.time)
-                for timeByte in varTime:
-                    self.MIDIdata = self.MIDIdata + struct.pack('>B',timeByte)
-                self.MIDIdata = self.MIDIdata + struct.pack('>B',code)
-                self.MIDIdata = self.MIDIdata + struct.pack('>B',subcode)
-                self.MIDIdata = self.MIDIdata + struct.pack('>B', 0x03) # Data length: 3
-                self.MIDIdata = self.MIDIdata + threebite
-            elif event.type == 'ProgramChange':
-                code = 0xC << 4 | event.channel
-                varTime = writeVarLength(event.time)
-                for timeByte in varTime:
-                    self.MIDIdata = self.MIDIdata + struct.pack('>B',timeByte)
-                self.MIDIdata = self.MIDIdata + struct.pack('>B',code)
-                self.MIDIdata = self.MIDIdata + struct.pack('>B',event.programNumber)
-            elif event.type == 'TrackName':
-                varTime = writeVarLength(event.time)
-                for timeByte in varTime:
-                    self.MIDIdata = self.MIDIdata + struct.pack('>B',timeByte)
-                self.MIDIdata = self.MIDIdata + struct.pack('B',0xFF) # Meta-event
-                self.MIDIdata = self.MIDIdata + struct.pack('B',0X03) # Event Type
-                dataLength = len(event.trackName)
-                dataLenghtVar = writeVarLength(dataLength)
-                for i in range(0,len(dataLenghtVar)):
-                    self.MIDIdata = self.MIDIdata + struct.pack("b",dataLenghtVar[i])
-                self.MIDIdata = self.MIDIdata + event.trackName.encode()
-            elif event.type == "ControllerEvent":
-                code = 0xB << 4 | event.channel
-                varTime = writeVarLength(event.time)
-                for timeByte in varTime:
-                    self.MIDIdata = self.MIDIdata + struct.pack('>B',timeByte)
-                self.MIDIdata = self.MIDIdata + struct.pack('>B',code)
-                self.MIDIdata = self.MIDIdata + struct.pack('>B',event.eventType)
-                self.MIDIdata = self.MIDIdata + struct.pack('>B',event.paramerter1)
-            elif event.type == "SysEx":
-                code = 0xF0
-                varTime = writeVarLength(event.time)
-                for timeByte in varTime:
-                    self.MIDIdata = self.MIDIdata + struct.pack('>B',timeByte)
-                self.MIDIdata = self.MIDIdata + struct.pack('>B', code)
-                
-                payloadLength = writeVarLength(len(event.payload)+2)
-                for lenByte in payloadLength:
-                    self.MIDIdata = self.MIDIdata + struct.pack('>B',lenByte)
-                    
-                self.MIDIdata = self.MIDIdata + struct.pack('>B', event.manID)
-                self.MIDIdata = self.MIDIdata + event.payload
-                self.MIDIdata = self.MIDIdata + struct.pack('>B',0xF7)
-            elif event.type == "UniversalSysEx":
-                code = 0xF0
-                varTime = writeVarLength(event.time)
-                for timeByte in varTime:
-                    self.MIDIdata = self.MIDIdata + struct.pack('>B',timeByte)
-                self.MIDIdata = self.MIDIdata + struct.pack('>B', code)
-                
-                # Do we need to add a length?
-                payloadLength = writeVarLength(len(event.payload)+5)
-                for lenByte in payloadLength:
-                    self.MIDIdata = self.MIDIdata + struct.pack('>B',lenByte)
-                
-                if event.realTime :
-                    self.MIDIdata = self.MIDIdata + struct.pack('>B', 0x7F)
-                else:
-                    self.MIDIdata = self.MIDIdata + struct.pack('>B', 0x7E)
-                    
-                self.MIDIdata = self.MIDIdata + struct.pack('>B', event.sysExChannel)
-                self.MIDIdata = self.MIDIdata + struct.pack('>B', event.code)
-                self.MIDIdata = self.MIDIdata + struct.pack('>B', event.subcode)
-                self.MIDIdata = self.MIDIdata + event.payload
-                self.MIDIdata = self.MIDIdata + struct.pack('>B',0xF7)
+            status, data = eventEncoders[event.type](event, compact)
+            chunks.append(bytes(writeVarLength(event.time)))
+            if status is None:
+                runningStatus = None
+            else:
+                if status != runningStatus:
+                    chunks.append(oneByte.pack(status))
+                if compact:
+                    runningStatus = status
+            chunks.append(data)
+            
+        self.MIDIdata = b"".join(chunks)
         
     def deInterleaveNotes(self):
         '''Correct Interleaved notes.
@@ -633,30 +680,36 @@ class MIDITrack:
     def adjustTime(self,origin):
         '''
         Adjust Times to be relative, and zero-origined
+        
+        The times are computed from eventTimes rather than from the events
+        themselves, so a track can be adjusted again against a new origin. With
+        NumPy the differences are computed on the whole array at once.
         '''
         
         if len(self.MIDIEventList) == 0:
             return
-        tempEventList = []
-    
-        runningTime = 0 
         
-        for event in self.MIDIEventList:
-            adjustedTime = event.time - origin
-            event.time = adjustedTime - runningTime
-            runningTime = adjustedTime
-            tempEventList.append(event)
-            
-        self.MIDIEventList = tempEventList
+        if numpy is not None:
+            deltas = numpy.diff(numpy.asarray(self.eventTimes, dtype=numpy.int64) - origin, \
+                                prepend=0).tolist()
+        else:
+            deltas = []
+            runningTime = 0 
+            for eventTime in self.eventTimes:
+                adjustedTime = eventTime - origin
+                deltas.append(adjustedTime - runningTime)
+                runningTime = adjustedTime
+        
+        for (event, delta) in zip(self.MIDIEventList, deltas):
+            event.time = delta
         
     def writeTrack(self,fileHandle):
         '''
         Write track to disk.
+        
+        The track must already have been encoded (see MIDIFile.close).
         '''
         
-        if not self.closed:
-            self.closeTrack()
-            
         fileHandle.write(self.headerString)
         fileHandle.write(self.dataLength)
         fileHandle.write(self.MIDIdata)
@@ -672,23 +725,22 @@ class MIDIHeader:
     complete and well formed MIDI pattern.
     
     '''
-    def __init__(self,numTracks):
+    def __init__(self,numTracks, format=1):
         ''' Initialize the data structures
+        
+        The packed header only depends on the format, the number of tracks and
+        TICKSPERBEAT, so it is packed once for each combination and reused.
         '''
-        self.headerString = struct.pack('cccc',b'M',b'T',b'h',b'd')
-        self.headerSize = struct.pack('>L',6)
-        # Format 1 = multi-track file
-        self.format = struct.pack('>H',1)
-        self.numTracks = struct.pack('>H',numTracks)
-        self.ticksPerBeat = struct.pack('>H',TICKSPERBEAT)
+        # Format 1 = multi-track file, format 0 = single track file
+        key = (format, numTracks, TICKSPERBEAT)
+        if key not in headerTemplates:
+            headerTemplates[key] = struct.pack('>4sLHHH', b'MThd', 6, format, \
+                                               numTracks, TICKSPERBEAT)
+        self.headerData = headerTemplates[key]
     
 
     def writeFile(self,fileHandle):
-        fileHandle.write(self.headerString)
-        fileHandle.write(self.headerSize)
-        fileHandle.write(self.format)
-        fileHandle.write(self.numTracks)
-        fileHandle.write(self.ticksPerBeat)
+        fileHandle.write(self.headerData)
 
 class MIDIFile:
     '''Class that represents a full, well-formed MIDI pattern.
@@ -698,7 +750,7 @@ class MIDIFile:
     
     Calling:
     
-        MyMIDI = MidiFile(tracks, removeDuplicates=True,  deinterleave=True)
+        MyMIDI = MidiFile(tracks, removeDuplicates=True,  deinterleave=True,  compact=False)
         
         normally
         
@@ -715,9 +767,16 @@ class MIDIFile:
         deinterleave: If True (the default), overlapping notes (same pitch, same
         channel) will be modified so that they do not overlap. Otherwise the sequencing
         software will need to figure out how to interpret NoteOff events upon playback.
+        
+        compact: If True, the tracks are written with a smaller encoding: channel
+        events use running status (a status byte identical to the previous one is
+        omitted), and NoteOff events are written as NoteOn events with a velocity of
+        zero so that they can share the NoteOn status byte. Both are part of the MIDI
+        standard. Defaults to False.
     '''
     
-    def __init__(self, numTracks, removeDuplicates=True,  deinterleave=True):
+    def __init__(self, numTracks, removeDuplicates=True,  deinterleave=True,  \
+                 compact=False):
         '''
         Initialize the class
         '''
@@ -726,9 +785,11 @@ class MIDIFile:
         self.tracks = list()
         self.numTracks = numTracks
         self.closed = False
+        self.format = 1
+        self.mergedTrack = None
         
         for i in range(0,numTracks):
-            self.tracks.append(MIDITrack(removeDuplicates,  deinterleave))
+            self.tracks.append(MIDITrack(removeDuplicates,  deinterleave,  compact))
             
             
     # Public Functions. These (for the most part) wrap the MIDITrack functions, where most
@@ -765,6 +826,65 @@ class MIDIFile:
         """
         self.tracks[track].addTrackName(time,trackName)
         
+    def addTimeSignature(self,track, time,numerator,denominator, \
+        clocksPerTick=24,notesPerQuarter=8):
+        """
+        Add a time signature event.
+        
+        Use:
+            MyMIDI.addTimeSignature(track, time, numerator, denominator)
+            
+        Arguments:
+            track: The track to which the event is added. [Integer, 0-127].
+            time: The time at which the event is added, in beats. [Float].
+            numerator: The number of beats in a bar. [Integer]
+            denominator: The note value of a beat (4 for crotchets, 8 for
+                quavers). [Integer, a power of two]
+            clocksPerTick: The number of MIDI clocks per metronome tick.
+                [Integer, default 24 (one tick per crotchet)]
+            notesPerQuarter: The number of 32nd notes in a crotchet.
+                [Integer, default 8]
+        """
+        self.tracks[track].addTimeSignature(time,numerator,denominator, \
+            clocksPerTick,notesPerQuarter)
+        
+    def addKeySignature(self,track, time,accidentals,mode=MAJOR):
+        """
+        Add a key signature event.
+        
+        Use:
+            MyMIDI.addKeySignature(track, time, accidentals, mode)
+            
+        Arguments:
+            track: The track to which the event is added. [Integer, 0-127].
+            time: The time at which the event is added, in beats. [Float].
+            accidentals: The number of sharps in the key signature, or minus
+                the number of flats. [Integer, -7 to 7]
+            mode: MAJOR or MINOR. [Integer, default MAJOR]
+        """
+        self.tracks[track].addKeySignature(time,accidentals,mode)
+        
+    def setTrackPrelude(self,track, trackName,tempo):
+        """
+        Set the track name and tempo at the start of a MIDI track.
+        
+        Use:
+            MyMIDI.setTrackPrelude(track,trackName,tempo)
+            
+        Arguments:
+            track: The track whose prelude is set. [Integer, 0-127].
+            trackName: The track name. [String].
+            tempo: The tempo, in Beats per Minute. [Integer]
+            
+        This is equivalent to adding a track name and a tempo event at time zero,
+        but cheaper: the encoded events are cached by track name and tempo and
+        copied directly into the track data rather than going through the event
+        list. The prelude is written at the start of the track.
+        """
+        self.tracks[track].setPrelude(trackName,tempo)
+        # The merged track of a format 0 file holds a copy of every prelude.
+        self.mergedTrack = None
+        
     def addTempo(self,track, time,tempo):
         """
         Add a tempo event.
@@ -811,12 +931,13 @@ class MIDIFile:
         self.tracks[track].addControllerEvent(channel,time,eventType, paramerter1)
         
     def changeNoteTuning(self,  track,  tunings,   sysExChannel=0x7F,  \
-                         realTime=False,  tuningProgam=0):
+                         realTime=False,  tuningProgam=0,  time=0):
         """
         Change a note's tuning using SysEx change tuning program.
             
         Use:
-            MyMIDI.changeNoteTuning(track,[tunings],realTime=False, tuningProgram=0)
+            MyMIDI.changeNoteTuning(track,[tunings],realTime=False, tuningProgram=0,
+                                    time=0)
             
         Arguments:
             track: The track to which the event is added. [Integer, 0-127].
@@ -825,6 +946,11 @@ class MIDIFile:
             realTime: Boolean which sets the real-time flag. Defaults to false.
             sysExChannel: do note use (see below).
             tuningProgram: Tuning program to assign. Defaults to zero. [Integer, 0-127]
+            time: The time at which the tuning changes, in beats. Defaults to
+                  zero. [Float]
+            
+        The frequencies are all transformed at once (see frequencyTransforms), so a
+        tuning of many notes costs little more than a tuning of one.
             
         In general the sysExChannel should not be changed (parameter will be depreciated).
         
@@ -832,23 +958,34 @@ class MIDIFile:
         this standard!
         """
         self.tracks[track].changeNoteTuning(tunings,   sysExChannel,  realTime,\
-                                              tuningProgam)
+                                              tuningProgam,  time)
   
-    def writeFile(self,fileHandle):
+    def writeFile(self,fileHandle, format=1, workers=1):
         '''
         Write the MIDI File.
         
         Use:
-            MyMIDI.writeFile(filehandle)
+            MyMIDI.writeFile(filehandle, format=1, workers=1)
         
         Arguments:
             filehandle: a file handle that has been opened for binary writing.
+            format: The Standard MIDI File format. Format 1 (the default) writes
+            one track chunk per track. Format 0 merges all of the tracks into a
+            single track chunk, for players that only understand format 0.
+            workers: The number of processes used to encode the tracks of a
+            format 1 file, or a concurrent.futures executor to encode them in.
+            Defaults to 1, which encodes them in this process (see close).
         '''
         
-        self.header.writeFile(fileHandle)
-        
         #Close the tracks and have them create the MIDI event data structures.
-        self.close()
+        self.close(format, workers)
+        
+        if format == 0:
+            MIDIHeader(1, 0).writeFile(fileHandle)
+            self.mergedTrack.writeTrack(fileHandle)
+            return
+        
+        self.header.writeFile(fileHandle)
         
         #Write the MIDI Events to file.
         for i in range(0,self.numTracks):
@@ -910,13 +1047,10 @@ class MIDIFile:
         words it is assumed to be called in the stage where the MIDIEventList has been
         created. This function, however, it meant to operate on the eventList itself.
         """
-        origin = 1000000 # A little silly, but we'll assume big enough
-
-        for track in self.tracks:
-                if len(track.eventList) > 0:
-                    for event in track.eventList:
-                        if event.time < origin:
-                            origin = event.time
+        eventTimes = [event.time for track in self.tracks for event in track.eventList]
+        if len(eventTimes) == 0:
+            return
+        origin = min(eventTimes)
         
         for track in self.tracks:
             tempEventList = []
@@ -930,51 +1064,368 @@ class MIDIFile:
                 tempEventList.append(event)
             
             track.eventList = tempEventList
+            track.dirty = True
+            track.encodedOrigin = None
 
     #End Public Functions ########################
     
-    def close(self):
-        '''Close the MIDIFile for further writing.
+    def close(self, format=1, workers=1):
+        '''Close the MIDIFile, preparing the encoded track data for writing.
         
         To close the File for events, we must close the tracks, adjust the time to be
         zero-origined, and have the tracks write to their MIDI Stream data structure.
+        
+        Closing is incremental. Only the tracks that have had events added since
+        they were last closed are processed again, and a track's encoded data is
+        reused unless the track changed or the origin of the file moved. Events may
+        therefore still be added after the file has been written, and the file
+        written again.
+        
+        Once the origin is known the tracks are independent of each other, so for a
+        format 1 file they can be encoded in a pool of worker processes: workers is
+        either the number of processes to start or a concurrent.futures executor to
+        submit them to. The output is identical to encoding them here. A track
+        encoded by a worker only has its MIDI data brought back, not its
+        MIDIEventList.
+        
+        For a format 0 file the tracks are instead merged into mergedTrack, which
+        is written in their place.
         '''
         
-        if self.closed == True:
-            return
-                
-        for i in range(0,self.numTracks):
-            self.tracks[i].closeTrack()
-            # We want things like program changes to come before notes when they are at the
-            # same time, so we sort the MIDI events by their ordinality
-            self.tracks[i].MIDIEventList.sort()
+        # Any change to the tracks invalidates the merged track.
+        if [track for track in self.tracks if track.dirty]:
+            self.mergedTrack = None
             
         origin = self.findOrigin()
 
-        for i in range(0,self.numTracks):
-            self.tracks[i].adjustTime(origin)
-            self.tracks[i].writeMIDIStream()
+        if format == 0:
+            if self.mergedTrack is None:
+                for i in range(0,self.numTracks):
+                    self.tracks[i].closeTrack()
+                self.mergedTrack = self.mergeTracks()
+                self.mergedTrack.adjustTime(origin)
+                self.mergedTrack.writeMIDIStream()
+        else:
+            staleTracks = [track for track in self.tracks if track.encodedOrigin != origin]
+            if isinstance(workers, concurrent.futures.Executor):
+                self.encodeTracks(staleTracks, origin, workers)
+            elif workers > 1 and len(staleTracks) > 1:
+                with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+                    self.encodeTracks(staleTracks, origin, executor)
+            else:
+                for track in staleTracks:
+                    encodeTrack(track, origin)
+                    track.encodedOrigin = origin
             
+        self.format = format
         self.closed = True
     
+    def encodeTracks(self, tracks, origin, executor):
+        '''Encode tracks in an executor's worker processes.
+        
+        Each track is sent to a worker, which closes and encodes it with
+        encodeTrack, and only the resulting MIDI data is returned.
+        '''
+        results = executor.map(encodeTrack, tracks, [origin] * len(tracks))
+        for (track, MIDIdata) in zip(tracks, results):
+            track.MIDIdata = MIDIdata
+            track.dataLength = struct.pack('>L',len(MIDIdata))
+            track.encodedOrigin = origin
+    
+    def mergeTracks(self):
+        '''Merge the closed tracks into a single track.
+        
+        Each track's MIDIEventList is already sorted, so rather than concatenating
+        and re-sorting them, the lists are combined with a k-way heap merge, which
+        is O(n log k) for n events in k tracks. The merge is stable, so events at
+        the same time and ordinality keep the order of their tracks.
+        '''
+        firstTrack = self.tracks[0]
+        mergedTrack = MIDITrack(firstTrack.remdep,  firstTrack.deinterleave,  \
+                                firstTrack.compact)
+        merged = list(heapq.merge(*[zip(track.eventTimes, track.MIDIEventList) \
+                                    for track in self.tracks], \
+                                  key=lambda pair: (pair[0], pair[1].ord)))
+        mergedTrack.eventTimes = [eventTime for (eventTime, event) in merged]
+        mergedTrack.MIDIEventList = [event for (eventTime, event) in merged]
+        mergedTrack.dirty = False
+        mergedTrack.prelude = b"".join([track.prelude for track in self.tracks])
+        return mergedTrack
+    
     
     def findOrigin(self):
-        '''Find the earliest time in the file's tracks.append.
+        '''Find the earliest time in the file's tracks, in ticks.
+        
+        The origin is found from the eventList of each track, so the tracks
+        don't have to be closed first. It is the time of the earliest event in the
+        tracks' MIDIEventLists, as no event (a NoteOff included) can be earlier than
+        the start of the earliest event in the eventList. A track prelude counts as
+        an event at time zero.
+        
+        Like the event times, the origin is rounded to a whole tick. A file with no
+        events has an origin of zero.
+        '''
+        startTimes = [min([event.time for event in track.eventList]) \
+                      for track in self.tracks if len(track.eventList) > 0]
+        if [track for track in self.tracks if track.prelude]:
+            startTimes.append(0)
+        if len(startTimes) == 0:
+            return 0
+        
+        return int(math.floor(min(startTimes) * TICKSPERBEAT + 0.5))
+
+class MIDIReader:
+    '''Class to read a Standard MIDI File.
+
+    The file is memory-mapped and parsed in place through a memoryview, so
+    chunk and event data are never copied. The track chunks are located when
+    the reader is created; the events of a track are only decoded when they
+    are asked for.
+
+    Calling:
+
+        MyReader = MIDIReader(fileName)
+
+        or, for data that is already in memory (for example the contents of
+        a BytesIO object written by MIDIFile.writeFile),
+
+        MyReader = MIDIReader(buffer)
+
+    Events are returned as tuples of the form
+
+        (time, status, data1, data2, payload)
+
+    time is the absolute time of the event in ticks and status is the status
+    byte, with running status already resolved. For channel events data1 and
+    data2 are the data bytes (data2 is zero for program change and channel
+    pressure) and payload is None. For meta events (status 0xFF) data1 is the
+    meta event type; for SysEx events (status 0xF0 or 0xF7) data1 is zero. In
+    both cases data2 is zero and payload is a memoryview of the event data.
+
+    Payloads are views into the mapped file. They stay usable after the
+    reader is closed, and the file is unmapped once the last one is dropped.
+    '''
+
+    def __init__(self, source):
+        '''
+        Map the file (or wrap the buffer) and locate the track chunks.
         '''
-        origin = 1000000 # A little silly, but we'll assume big enough
+        self.map = None
+        self.trackData = []
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            self.data = memoryview(source)
+        else:
+            with open(source, 'rb') as fileHandle:
+                self.map = mmap.mmap(fileHandle.fileno(), 0, access=mmap.ACCESS_READ)
+            self.data = memoryview(self.map)
+
+        if len(self.data) < 14 or self.data[0:4] != b'MThd':
+            self.close()
+            raise ValueError("Not a Standard MIDI File: no MThd chunk")
+
+        (headerSize, self.format, self.headerTracks, self.division) = \
+            struct.unpack_from('>LHHH', self.data, 4)
+        # The division is in ticks per beat unless the top bit (SMPTE) is set.
+        if self.division & 0x8000:
+            self.ticksPerBeat = None
+        else:
+            self.ticksPerBeat = self.division
 
-    # Note: This code assumes that the MIDIEventList has been sorted, so this should be insured
-    # before it is called. It is probably a poor design to do this. 
-    # TODO: -- Consider making this less efficient but more robust by not assuming the list to be sorted.
+        # Walk the chunks, keeping a view of the body of each MTrk chunk and
+        # skipping any chunk type we don't know about.
+        offset = 8 + headerSize
+        end = len(self.data)
+        while offset + 8 <= end:
+            chunkSize = struct.unpack_from('>L', self.data, offset + 4)[0]
+            start = offset + 8
+            if start + chunkSize > end:
+                self.close()
+                raise ValueError("Truncated chunk at offset %d" % offset)
+            if self.data[offset:offset + 4] == b'MTrk':
+                self.trackData.append(self.data[start:start + chunkSize])
+            offset = start + chunkSize
+
+        self.numTracks = len(self.trackData)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def close(self):
+        '''
+        Release the views of the data and unmap the file.
+
+        Payloads that are still held (for example the last payload of a loop
+        over events) keep the mapping alive: it is then left to be unmapped
+        when they are dropped, rather than raising BufferError here.
+        '''
+        for view in self.trackData:
+            view.release()
+        self.trackData = []
+        self.data.release()
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                pass
+            self.map = None
+
+    def scanEvents(self, track):
+        '''
+        Decode the events of a track without creating payload views.
+
+        This generator is the parser proper. It yields tuples of the form
+        (time, status, data1, data2, start, length), where start and length
+        locate the payload of a meta or SysEx event within trackData[track].
+        Both are zero for channel events.
+
+        A track whose data stops partway through an event raises ValueError.
+        '''
+        data = self.trackData[track]
+        end = len(data)
+        offset = 0
+        time = 0
+        runningStatus = 0
+
+        # Reading past the end of the data means the last event is cut short.
+        try:
+            while offset < end:
+                # Delta time, a variable length quantity. This is readVarLength,
+                # unrolled for speed.
+                byte = data[offset]
+                offset += 1
+                delta = byte & 0x7F
+                while byte & 0x80:
+                    byte = data[offset]
+                    offset += 1
+                    delta = (delta << 7) | (byte & 0x7F)
+                time += delta
+
+                status = data[offset]
+                if status & 0x80:
+                    offset += 1
+                elif runningStatus:
+                    status = runningStatus
+                else:
+                    raise ValueError("Data byte without running status in track %d" \
+                                     % track)
+
+                if status < 0xF0:
+                    runningStatus = status
+                    data1 = data[offset]
+                    if 0xC0 <= status < 0xE0:
+                        data2 = 0
+                        offset += 1
+                    else:
+                        data2 = data[offset + 1]
+                        offset += 2
+                    yield (time, status, data1, data2, 0, 0)
+                    continue
+
+                # SysEx and meta events cancel running status.
+                runningStatus = 0
+                if status == 0xFF:
+                    data1 = data[offset]
+                    offset += 1
+                elif status == 0xF0 or status == 0xF7:
+                    data1 = 0
+                else:
+                    raise ValueError("Unexpected status byte 0x%02X in track %d" \
+                                     % (status, track))
+
+                byte = data[offset]
+                offset += 1
+                length = byte & 0x7F
+                while byte & 0x80:
+                    byte = data[offset]
+                    offset += 1
+                    length = (length << 7) | (byte & 0x7F)
+                if offset + length > end:
+                    raise ValueError("Truncated event in track %d" % track)
+
+                yield (time, status, data1, 0, offset, length)
+                offset += length
+
+                if status == 0xFF and data1 == 0x2F:  # End of track
+                    return
+        except IndexError:
+            raise ValueError("Truncated event in track %d" % track)
+
+    def events(self, track):
+        '''
+        Yield the events of a track, lazily.
+
+        Use:
+            for (time, status, data1, data2, payload) in MyReader.events(track):
+                ...
+        '''
+        data = self.trackData[track]
+        for (time, status, data1, data2, start, length) in self.scanEvents(track):
+            if status < 0xF0:
+                yield (time, status, data1, data2, None)
+            else:
+                yield (time, status, data1, data2, data[start:start + length])
+
+    def columns(self, track):
+        '''
+        Return the events of a track as NumPy arrays.
+
+        The result is a dictionary of equal-length arrays keyed by 'time',
+        'status', 'data1', 'data2', 'start' and 'length' (see scanEvents). NumPy
+        is only needed for this function.
+        '''
+        if numpy is None:
+            raise ImportError("MIDIReader.columns requires NumPy")
+
+        times = array.array('q')
+        statuses = array.array('B')
+        data1s = array.array('B')
+        data2s = array.array('B')
+        starts = array.array('q')
+        lengths = array.array('q')
+        for (time, status, data1, data2, start, length) in self.scanEvents(track):
+            times.append(time)
+            statuses.append(status)
+            data1s.append(data1)
+            data2s.append(data2)
+            starts.append(start)
+            lengths.append(length)
+
+        return {'time': numpy.frombuffer(times, dtype=numpy.int64),
+                'status': numpy.frombuffer(statuses, dtype=numpy.uint8),
+                'data1': numpy.frombuffer(data1s, dtype=numpy.uint8),
+                'data2': numpy.frombuffer(data2s, dtype=numpy.uint8),
+                'start': numpy.frombuffer(starts, dtype=numpy.int64),
+                'length': numpy.frombuffer(lengths, dtype=numpy.int64)}
+
+def encodeTrack(track, origin):
+    '''Close and encode a track against the given origin, returning its MIDI data.
     
-        for track in self.tracks:
-                if len(track.MIDIEventList) > 0:
-                    if track.MIDIEventList[0].time < origin:
-                        origin = track.MIDIEventList[0].time
-                        
-        
-        return origin
-            
+    This is a module-level function so that it can be sent to worker processes
+    (see MIDIFile.close).
+    '''
+    track.closeTrack()
+    track.adjustTime(origin)
+    track.writeMIDIStream()
+    return track.MIDIdata
+
+def encodeTrackPrelude(trackName, tempo):
+    '''Return the encoded track name and tempo events that start a track.
+    
+    The result is cached in preludeTemplates, so each prelude is only encoded
+    once.
+    '''
+    key = (trackName, tempo, TICKSPERBEAT)
+    if key not in preludeTemplates:
+        name = trackName.encode()
+        preludeTemplates[key] = struct.pack('>BBB', 0x00, 0xFF, 0x03) + \
+            bytes(writeVarLength(len(name))) + name + \
+            struct.pack('>BBBB', 0x00, 0xFF, 0x51, 0x03) + \
+            struct.pack('>L', int(60000000 / tempo))[1:4]
+    return preludeTemplates[key]
+
 def writeVarLength(i):
     '''Accept an input, and write a MIDI-compatible variable length stream
     
@@ -1045,6 +1496,41 @@ def frequencyTransform(freq):
     thirdByte = int(thirdByte)
     return [firstByte,  secondByte,  thirdByte]
     
+def frequencyTransforms(freqs):
+    '''Returns the three-byte transforms of a sequence of frequencies.
+    
+    This is frequencyTransform applied to every frequency, and gives the same
+    bytes. With NumPy the whole sequence is transformed at once.
+    '''
+    if numpy is None:
+        return [frequencyTransform(freq) for freq in freqs]
+    
+    resolution = 16384
+    freqs = numpy.asarray(freqs, dtype=numpy.float64)
+    # numpy.log(x)/numpy.log(2) rather than numpy.log2, to round exactly as
+    # math.log(x, 2) does.
+    dollars = 69 + 12 * (numpy.log(freqs/440.0) / numpy.log(2.0))
+    firstBytes = dollars.astype(numpy.int64)
+    lowerFreqs = 440 * numpy.power(2.0, (firstBytes - 69.0)/12.0)
+    centDifs = numpy.where(freqs != lowerFreqs, \
+                           1200 * (numpy.log(freqs/lowerFreqs) / numpy.log(2.0)), 0.0)
+    cents = numpy.round(centDifs/100 * resolution).astype(numpy.int64)
+    secondBytes = numpy.minimum(cents >> 7, 0x7F)
+    thirdBytes = numpy.minimum(cents - (secondBytes << 7), 0x7F)
+    thirdBytes[(thirdBytes == 0x7F) & (secondBytes == 0x7F) & (firstBytes == 0x7F)] = 0x7E
+    return numpy.stack([firstBytes, secondBytes, thirdBytes], axis=1).tolist()
+
+def encodeNoteTunings(tunings):
+    '''Encode a list of (noteNumber, frequency) tuples for a note tuning message.
+    
+    Each note is encoded as four bytes: the note number and the three-byte
+    transform of its frequency. The result can be cached and used as (part of)
+    the payload of a Universal SysEx note tuning change (code 8, subcode 2).
+    '''
+    freqBytes = frequencyTransforms([frequency for (noteNumber, frequency) in tunings])
+    return bytes([byte for ((noteNumber, frequency), MIDIFrequency) in \
+                  zip(tunings, freqBytes) for byte in [noteNumber] + MIDIFrequency])
+
 def returnFrequency(freqBytes):
     '''The reverse of frequencyTransform. Given a byte stream, return a frequency.
     '''
@@ -4,8 +4,12 @@ An implementation of voice leading via python.
 David Berghoff
 """
 
+import collections
+import io
 import itertools
+import os
 import random
+import time
 
 PITCH_MAPPING = {"C": 0, "B#": 0, "Dbb": 0, "B##": 1, "C#": 1, "Db": 1,
 "C##": 2, "D": 2, "Ebb": 2, "D#": 3, "Eb": 3, "Fbb": 3, "D##": 4, "E": 4, "Fb": 4,
@@ -23,14 +27,14 @@ def _check_valid_note(note_name):
 	Checks that the given note is a valid note in the given harmonic system.
 	"""
 	if note_name not in PITCH_MAPPING:
-		raise TypeError, str(note_name) + " is not a valid note name"
+		raise TypeError(str(note_name) + " is not a valid note name")
 
 def _check_valid_octave(octave):
 	"""
 	Checks that the given octave is valid within the given register.
 	"""
 	if (type(octave) != int) or (octave < REGISTER_MIN) or (octave > REGISTER_MAX):
-		raise TypeError, str(octave) + " is not a valid octave"
+		raise TypeError(str(octave) + " is not a valid octave")
 
 class Note:
 	"""
@@ -180,18 +184,24 @@ CHORD_QUALITY_TO_INVERSION = {"Maj": 0, "Maj6": 1, "Maj64": 2,
 "Dim": 0, "Dim6": 1, "Dim64": 2, "Dom7": 0, "Dom65": 1,
 "Dom43": 2, "Dom42": 3}
 
+# The root of each chord quality, as an interval (mod 12) above the bass.
+CHORD_QUALITY_TO_ROOT_INTERVAL = {"Maj": 0, "Maj6": 8, "Maj64": 5,
+"Min": 0, "Min6": 9, "Min64": 5, "Aug": 0, "Aug6": 8, "Aug64": 4,
+"Dim": 0, "Dim6": 9, "Dim64": 6, "Dom7": 0, "Dom65": 8,
+"Dom43": 5, "Dom42": 2}
+
 def _check_notes_in_range(notes):
 	"""
 	Checks that the given notes are valid for a standard 4-part choir.
 	"""
 	if (notes[0] < BASS_REGISTER_MIN) or (notes[0] > BASS_REGISTER_MAX):
-		raise TypeError, str(notes[0]) + " is not a valid not for a bass"
+		raise TypeError(str(notes[0]) + " is not a valid not for a bass")
 	if (notes[1] < TENOR_REGISTER_MIN) or (notes[1] > TENOR_REGISTER_MAX):
-		raise TypeError, str(notes[1]) + " is not a valid not for a tenor"
+		raise TypeError(str(notes[1]) + " is not a valid not for a tenor")
 	if (notes[2] < ALTO_REGISTER_MIN) or (notes[2] > ALTO_REGISTER_MAX):
-		raise TypeError, str(notes[2]) + " is not a valid not for an alto"
+		raise TypeError(str(notes[2]) + " is not a valid not for an alto")
 	if (notes[3] < SOPR_REGISTER_MIN) or (notes[3] > SOPR_REGISTER_MAX):
-		raise TypeError, str(notes[3]) + " is not a valid not for a soprano"
+		raise TypeError(str(notes[3]) + " is not a valid not for a soprano")
 
 def get_chord_number(notes):
 	"""
@@ -230,13 +240,13 @@ def _check_chord_matches_notes(notes, quality):
 	chord quality, and checks if given quality is valid.
 	"""
 	if quality not in CHORD_QUALITY_TO_STRUCTURE:
-		raise TypeError, str(quality) + " is not a valid chord quality"
+		raise TypeError(str(quality) + " is not a valid chord quality")
 
 	chord_number1 = get_chord_number(notes)
 	chord_number2 = CHORD_QUALITY_TO_STRUCTURE[quality]
 
 	if chord_number2 != chord_number1:
-		raise TypeError, str(quality) + " does not match the given notes"
+		raise TypeError(str(quality) + " does not match the given notes")
 
 class Chord:
 	"""
@@ -261,6 +271,9 @@ class Chord:
 		self._alto = notes[2].get_note()
 		self._sopr = notes[3].get_note()
 		self._quality = str(quality)
+		# The rules work on the MIDI numbers (see get_voice_intervals).
+		self._midi_numbers = tuple([note.get_midi_number() for note in notes])
+		self._voice_intervals = None
 
 	def __str__(self):
 		string = "A " + self._quality + " Chord:"
@@ -290,6 +303,60 @@ class Chord:
 		return Chord(self._bass.get_note(), self._tenor.get_note(),
 			self._alto.get_note(), self._sopr.get_note(), str(self._quality))
 
+	def get_quality(self):
+		"""
+		Returns a copy of the quality of the chord (e.g. "Maj6").
+		"""
+		return str(self._quality)
+
+	def get_root_number(self):
+		"""
+		Returns the pitch number (C is 0) of the root of the chord.
+		"""
+		return (self._bass.get_note_number() +
+			CHORD_QUALITY_TO_ROOT_INTERVAL[self._quality]) % 12
+
+	def get_voicing(self):
+		"""
+		Returns the names and octaves of the four notes (bass first), as a
+		tuple of (name, octave) pairs, which can be used as a dictionary key.
+		"""
+		return ((self._bass._note_name, self._bass._octave),
+			(self._tenor._note_name, self._tenor._octave),
+			(self._alto._note_name, self._alto._octave),
+			(self._sopr._note_name, self._sopr._octave))
+
+	def get_midi_numbers(self):
+		"""
+		Returns the MIDI numbers of the four notes (bass first), without
+		copying the notes.
+		"""
+		return list(self._midi_numbers)
+
+	def get_voice_intervals(self):
+		"""
+		Returns the intervals between each pair of voices, in the order of
+		VOICE_PAIRS (see get_voice_intervals), worked out the first time.
+		"""
+		if self._voice_intervals is None:
+			self._voice_intervals = get_voice_intervals(self._midi_numbers)
+		return self._voice_intervals
+
+# The six pairs of voices (0 being the bass), in the order of
+# get_voice_intervals.
+VOICE_PAIRS = ((0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3))
+
+def get_voice_intervals(midi_numbers):
+	"""
+	Returns get_interval between each pair of voices in VOICE_PAIRS, given
+	the MIDI numbers of the four voices, as a tuple. On MIDI numbers,
+	get_interval is the distance between the notes, mod 12.
+	"""
+	bass, tenor, alto, sopr = midi_numbers
+	return (abs(tenor - bass) % 12, abs(alto - bass) % 12,
+		abs(sopr - bass) % 12, abs(alto - tenor) % 12, abs(sopr - tenor) % 12,
+		abs(sopr - alto) % 12)
+
 def get_chord_notes(quality, root):
 	"""
 	Given a chord quality and a root note, the notes of the chord are
@@ -406,31 +473,171 @@ def get_nearest_note(current_note, next_note_name,
 
 	return next_note.get_note()
 
+# The register of each voice, indexed by its number (0 being the bass), as in
+# VOICE_PAIRS.
+VOICE_REGISTERS = [(BASS_REGISTER_MIN, BASS_REGISTER_MAX),
+	(TENOR_REGISTER_MIN, TENOR_REGISTER_MAX),
+	(ALTO_REGISTER_MIN, ALTO_REGISTER_MAX),
+	(SOPR_REGISTER_MIN, SOPR_REGISTER_MAX)]
+
+def _get_registers():
+	return [(low.get_midi_number(), high.get_midi_number())
+		for low, high in VOICE_REGISTERS]
+
+# The MIDI number of the note get_nearest_note gives in each register of
+# VOICE_REGISTERS, indexed by (register, next note name), and then by the
+# MIDI number of the current note (see get_nearest_note_table).
+_NEAREST_NOTES = None
+
+def get_nearest_note_table():
+	"""
+	Returns the table of the notes get_nearest_note gives in each register of
+	VOICE_REGISTERS, for every current note and next note name, building it
+	the first time. None stands for no note in the register.
+	"""
+	global _NEAREST_NOTES
+	if _NEAREST_NOTES is None:
+		table = {}
+		for register, (low, high) in enumerate(_get_registers()):
+			for note_name in PITCH_MAPPING:
+				pitch_number = PITCH_MAPPING[note_name]
+				# Like get_nearest_note, the highest of the note in the octave
+				# below, the same octave and the octave above that fits the
+				# register. The MIDI number of the current note determines its
+				# octave, whatever its name.
+				by_octave = []
+				for octave in range(REGISTER_MIN, REGISTER_MAX + 1):
+					nearest = None
+					for next_octave in [octave - 1, octave, octave + 1]:
+						midi_number = pitch_number + (next_octave + 1) * 12
+						if (REGISTER_MIN <= next_octave <= REGISTER_MAX and
+							low <= midi_number <= high):
+							nearest = midi_number
+					by_octave.append(nearest)
+				table[(register, note_name)] = tuple([by_octave[octave]
+					for octave in range(REGISTER_MIN, REGISTER_MAX + 1)
+					for pitch in range(12)])
+		_NEAREST_NOTES = table
+	return _NEAREST_NOTES
+
+def _nearest_note(current_midi_number, next_note_name, register):
+	"""
+	Returns the same as get_nearest_note in the given register of
+	VOICE_REGISTERS, looked up in get_nearest_note_table.
+	"""
+	table = _NEAREST_NOTES
+	if table is None:
+		table = get_nearest_note_table()
+	midi_number = table[(register, next_note_name)][current_midi_number - 12]
+	if midi_number is None:
+		low, high = VOICE_REGISTERS[register]
+		raise TypeError("No " + str(next_note_name) + " between " + str(low) +
+			" and " + str(high) + " is near enough to MIDI note " +
+			str(current_midi_number))
+	return Note(next_note_name,
+		(midi_number - PITCH_MAPPING[next_note_name]) // 12 - 1)
+
+# How far (in semitones) get_register_candidates lets each voice move.
+MAX_VOICE_MOTION = 12
+
+def get_register_candidates(current_chord, next_quality, next_bass_name,
+	max_motion=MAX_VOICE_MOTION):
+	"""
+	Returns every voicing of the next chord, given the name of its bass, in
+	which each voice is within its register and moves at most max_motion
+	semitones from the current chord, the voices do not cross, and the upper
+	voices are no more than an octave apart. Each is a tuple of the four
+	notes, as (MIDI number, note name, octave), bass first. The list is empty
+	if there are none.
+	"""
+	current = current_chord._midi_numbers
+	registers = _get_registers()
+	chord_notes = get_chord_notes(next_quality, Note(next_bass_name, 4))
+
+	placements = []
+	for voice, (low, high) in enumerate(registers):
+		if voice == 0:
+			note_names = [next_bass_name]
+		else:
+			note_names = chord_notes
+		voice_placements = []
+		for note_name in note_names:
+			for octave in range(REGISTER_MIN, REGISTER_MAX + 1):
+				midi_number = PITCH_MAPPING[note_name] + (octave + 1) * 12
+				if (low <= midi_number <= high and
+					abs(midi_number - current[voice]) <= max_motion):
+					voice_placements.append((midi_number, note_name, octave))
+		placements.append(voice_placements)
+
+	all_notes = set(chord_notes)
+	candidates = []
+	for bass, tenor, alto, sopr in itertools.product(*placements):
+		if (bass[0] <= tenor[0] <= alto[0] <= sopr[0] and
+			sopr[0] - alto[0] <= 12 and alto[0] - tenor[0] <= 12 and
+			set([bass[1], tenor[1], alto[1], sopr[1]]) == all_notes):
+			candidates.append((bass, tenor, alto, sopr))
+	return candidates
+
+def _get_next_chord_in_register(current_chord, next_quality, next_bass_name,
+	key):
+	"""
+	get_next_chord over get_register_candidates, or None if there are none.
+	"""
+	current = current_chord._midi_numbers
+	# The leaps are the first rule, and no rule takes anything off, so the
+	# candidates are tried from the smallest leaps (and then the least
+	# motion) until the leaps alone can no longer beat the best.
+	ordered = []
+	for candidate in get_register_candidates(current_chord, next_quality,
+		next_bass_name):
+		leaps = 0
+		motion = 0
+		for voice, note in enumerate(candidate):
+			if voice > 0:
+				leaps += abs(note[0] - current[voice]) % 12
+			motion += abs(note[0] - current[voice])
+		ordered.append((leaps, motion, [note[0] for note in candidate],
+			candidate))
+	ordered.sort(key=lambda item: item[:3])
+
+	min_eval = float("inf")
+	next_chord = None
+	for number, (leaps, motion, midi_numbers, candidate) in enumerate(ordered):
+		if leaps / float(LEAPS_DIVISOR) >= min_eval:
+			# The rest have leaps at least as large, so none of them can win.
+			RULE_EVALUATIONS["skipped"] += ((len(ordered) - number) *
+				len(PROGRESSION_RULES))
+			break
+		chord = Chord(*[Note(note_name, octave)
+			for midi_number, note_name, octave in candidate] + [next_quality])
+		evaluation = evaluate_progression_bounded(current_chord, chord, key,
+			min_eval)
+		if evaluation < min_eval:
+			min_eval = evaluation
+			next_chord = chord
+	return next_chord
+
 def has_parallels(chord1, chord2):
 	"""
 	Returns True if there are parallel 5ths or octaves
 	in the given two chords.
 	"""
-	notes1 = chord1.get_notes()
-	notes2 = chord2.get_notes()
-	for index_a, note_a in enumerate(notes1):
-		for index_b, note_b in enumerate(notes1):
-			if note_a != note_b:
-				if get_interval(note_a, note_b) == get_interval(
-					notes2[index_a], notes2[index_b]):
-					if (get_interval(note_a, note_b) == 7) or (
-						get_interval(note_a, note_b) == 0):
-						return True
+	# The notes of a chord are all spelled from its quality, so two of its
+	# notes are the same exactly when their MIDI numbers are.
+	notes1 = chord1._midi_numbers
+	intervals2 = chord2.get_voice_intervals()
+	for pair, interval in enumerate(chord1.get_voice_intervals()):
+		if (interval == 7 or interval == 0) and interval == intervals2[pair]:
+			index_a, index_b = VOICE_PAIRS[pair]
+			if notes1[index_a] != notes1[index_b]:
+				return True
 	return False
 
 def has_voice_crossing(chord):
 	"""
 	Returns True if voices have crossed registers.
 	"""
-	bass = chord.get_bass()
-	tenor = chord.get_tenor()
-	alto = chord.get_alto()
-	sopr = chord.get_sopr()
+	bass, tenor, alto, sopr = chord._midi_numbers
 
 	return (bass > tenor) or (tenor > alto) or (alto > sopr)
 
@@ -439,13 +646,7 @@ def has_octave_gap(chord):
 	Returns True if there is a gap between voices (excluding the bass) of
 	more than an octave.
 	"""
-	tenor = chord.get_tenor()
-	alto = chord.get_alto()
-	sopr = chord.get_sopr()
-
-	tenor_num = tenor.get_midi_number()
-	alto_num = alto.get_midi_number()
-	sopr_num = sopr.get_midi_number()
+	bass_num, tenor_num, alto_num, sopr_num = chord._midi_numbers
 
 	return ((sopr_num - alto_num) > 12) or ((alto_num - tenor_num) > 12)
 
@@ -458,9 +659,8 @@ def has_doubled_leading_tone(chord, key):
 	leading_tone_num = (key_num - 1) % 12
 
 	count = 0
-	chord_notes = chord.get_notes()
-	for note in chord_notes:
-		if note.get_note_number() == leading_tone_num:
+	for midi_number in chord._midi_numbers:
+		if midi_number % 12 == leading_tone_num:
 			count += 1
 
 	return count > 1
@@ -472,17 +672,19 @@ def evaluate_leaps(chord1, chord2):
 	sevenths).
 	"""
 	total = 0
-	notes1 = chord1.get_notes()
-	notes2 = chord2.get_notes()
-	# To eliminate the bass
-	notes1.pop(0)
-	notes2.pop(0)
-
-	for note1, note2 in zip(notes1, notes2):
-		total += get_interval(note1, note2)
+	# [1:] to eliminate the bass
+	for note1, note2 in zip(chord1._midi_numbers[1:], chord2._midi_numbers[1:]):
+		total += abs(note2 - note1) % 12
 
 	return total
 
+# What evaluate_progression adds for breaking each rule, the leaps being the
+# sum of the intervals divided by LEAPS_DIVISOR. PROGRESSION_RULES and
+# TransitionGraph take their weights from here too.
+LEAPS_DIVISOR = 100
+RULE_WEIGHTS = {"voice_crossing": .1, "octave_gap": .2,
+	"doubled_leading_tone": .5, "parallels": 1}
+
 def evaluate_progression(chord1, chord2, key):
 	"""
 	Returns a numerical representation of the quality of the progression.
@@ -491,34 +693,80 @@ def evaluate_progression(chord1, chord2, key):
 	"""
 	total = 0.0
 	# leaps are small problems, and unless there are a large number, they are fine
-	total += (evaluate_leaps(chord1, chord2) / float(100))
+	total += (evaluate_leaps(chord1, chord2) / float(LEAPS_DIVISOR))
 	# voice crossing is worse than leaps
 	if has_voice_crossing(chord2):
-		total += .1
+		total += RULE_WEIGHTS["voice_crossing"]
 	# Octave gaps are even worse
 	if has_octave_gap(chord2):
-		total += .2
+		total += RULE_WEIGHTS["octave_gap"]
 	# Doubled leading tones are not good.
 	if has_doubled_leading_tone(chord2, key):
-		total += .5
+		total += RULE_WEIGHTS["doubled_leading_tone"]
 	# Parallel octaves and fifths are the worst.
 	if has_parallels(chord1, chord2):
-		total += 1
+		total += RULE_WEIGHTS["parallels"]
 
 	return total
 
-def get_next_chord(current_chord,next_quality,next_root_name,key,prev_chord=None):
+# The rules of evaluate_progression, as the amount each adds to the total, in
+# the order it adds them: the cheapest first, and parallels (which compare
+# every pair of voices) last.
+PROGRESSION_RULES = [
+	lambda chord1, chord2, key:
+		evaluate_leaps(chord1, chord2) / float(LEAPS_DIVISOR),
+	lambda chord1, chord2, key:
+		RULE_WEIGHTS["voice_crossing"] if has_voice_crossing(chord2) else 0,
+	lambda chord1, chord2, key:
+		RULE_WEIGHTS["octave_gap"] if has_octave_gap(chord2) else 0,
+	lambda chord1, chord2, key: RULE_WEIGHTS["doubled_leading_tone"]
+		if has_doubled_leading_tone(chord2, key) else 0,
+	lambda chord1, chord2, key:
+		RULE_WEIGHTS["parallels"] if has_parallels(chord1, chord2) else 0]
+
+# How many of PROGRESSION_RULES evaluate_progression_bounded has checked and
+# skipped, under "checked" and "skipped".
+RULE_EVALUATIONS = collections.Counter()
+
+def evaluate_progression_bounded(chord1, chord2, key, bound=float("inf")):
+	"""
+	Returns the same as evaluate_progression, unless it is at least bound, in
+	which case it may stop checking the rules as soon as the total reaches
+	bound, and return that total instead. The rules never take anything off
+	the total, so the candidates this stops early for can never beat bound.
+	"""
+	total = 0.0
+	for number, rule in enumerate(PROGRESSION_RULES):
+		if total >= bound:
+			RULE_EVALUATIONS["checked"] += number
+			RULE_EVALUATIONS["skipped"] += len(PROGRESSION_RULES) - number
+			return total
+		total += rule(chord1, chord2, key)
+	RULE_EVALUATIONS["checked"] += len(PROGRESSION_RULES)
+	return total
+
+def get_next_chord(current_chord,next_quality,next_root_name,key,prev_chord=None,
+	full_register=False):
 	"""
 	Generates the next chord in a progression, given the next
 	chord's quality and the previous chord, along with the name of
 	the next root (e.g. "F#"). The key of the progression must be given
 	as well in order to ensure that the leading tone is never doubled.
 	ALSO, MAYBE LATER ADD PREVIOUS CHORD FOR EXTRA CHECKS? MAYBE.
+	By default each voice only considers the note get_nearest_note gives;
+	with full_register, every voicing from get_register_candidates is
+	considered, falling back on get_nearest_note if there are none.
 	"""
+	if full_register:
+		next_chord = _get_next_chord_in_register(current_chord, next_quality,
+			next_root_name, key)
+		if next_chord is not None:
+			return next_chord
+
 	# First, find the next bass note.
-	current_bass = current_chord.get_bass()
-	next_bass = get_nearest_note(current_bass, next_root_name, 
-		BASS_REGISTER_MIN, BASS_REGISTER_MAX)
+	current_bass, current_tenor, current_alto, current_sopr = \
+		current_chord._midi_numbers
+	next_bass = _nearest_note(current_bass, next_root_name, 0)
 
 	# Now that the next bass is known, the needed notes can be determined
 	chord_notes = get_chord_notes(next_quality, next_bass)
@@ -528,21 +776,15 @@ def get_next_chord(current_chord,next_quality,next_root_name,key,prev_chord=None
 	# Now find all of the possible chords that contain these needed notes
 	# For sevenths, no note is doubled, so using itertools, all possibilities
 	# can be found.
-	current_tenor = current_chord.get_tenor()
-	current_alto = current_chord.get_alto()
-	current_sopr = current_chord.get_sopr()
 	poss_chords = []
 
 	if len(needed_chord_notes) == 3:
 		all_perms = list(itertools.permutations(needed_chord_notes))
 		for needed_notes in all_perms:
 			poss_chords.append(Chord(next_bass, 
-				get_nearest_note(current_tenor, needed_notes[0], 
-					TENOR_REGISTER_MIN, TENOR_REGISTER_MAX),
-				get_nearest_note(current_alto, needed_notes[1], 
-					ALTO_REGISTER_MIN, ALTO_REGISTER_MAX),
-				get_nearest_note(current_sopr, needed_notes[2], 
-					SOPR_REGISTER_MIN, SOPR_REGISTER_MAX),
+				_nearest_note(current_tenor, needed_notes[0], 1),
+				_nearest_note(current_alto, needed_notes[1], 2),
+				_nearest_note(current_sopr, needed_notes[2], 3),
 				next_quality))
 
 	# Triads are slightly more difficult to find all possible permutations, 
@@ -558,33 +800,861 @@ def get_next_chord(current_chord,next_quality,next_root_name,key,prev_chord=None
 
 		for needed_notes in all_perms:
 			poss_chords.append(Chord(next_bass, 
-				get_nearest_note(current_tenor, needed_notes[0], 
-					TENOR_REGISTER_MIN, TENOR_REGISTER_MAX),
-				get_nearest_note(current_alto, needed_notes[1], 
-					ALTO_REGISTER_MIN, ALTO_REGISTER_MAX),
-				get_nearest_note(current_sopr, needed_notes[2], 
-					SOPR_REGISTER_MIN, SOPR_REGISTER_MAX),
+				_nearest_note(current_tenor, needed_notes[0], 1),
+				_nearest_note(current_alto, needed_notes[1], 2),
+				_nearest_note(current_sopr, needed_notes[2], 3),
 				next_quality))
 
 	# Now evaluate each of these possible chords using the rules in
-	# evaluate_progression
-	evaluations = []
-	for chord in poss_chords:
-		evaluations.append(evaluate_progression(current_chord, chord, key))
-
-	# Now find the index of the lowest evaluation score
+	# evaluate_progression, and find the index of the lowest evaluation score.
+	# Candidates stop being evaluated once they can no longer beat the best.
 	min_eval = float("inf")
-	for index, evaluation in enumerate(evaluations):
+	for index, chord in enumerate(poss_chords):
+		evaluation = evaluate_progression_bounded(current_chord, chord, key,
+			min_eval)
 		if evaluation < min_eval:
 			min_eval = evaluation
 			min_index = index
 
-	# print evaluations
-	# print min_eval
+	# print(evaluations)
+	# print(min_eval)
 	next_chord = poss_chords[min_index]
-	# print evaluate_progression(current_chord, next_chord, key)
+	# print(evaluate_progression(current_chord, next_chord, key))
 	return next_chord
 
+class NextChordMemo:
+	"""
+	A memo of get_next_chord, for services that voice the same transitions
+	over and over. The next chord only depends on the notes of the current
+	chord, the next quality and root, and the key, so these are the key of
+	the memo. At most capacity results are kept, evicting the least recently
+	used. hits and misses count the lookups, to size the memo by. If
+	new_chords is a list, the (memo key, next chord) pair of each miss is
+	appended to it, so the new results can be saved (see
+	save_next_chord_table). If table is a SharedNextChordTable, results
+	missing from the memo are looked up there (and not added to the memo)
+	before they are worked out.
+	"""
+	def __init__(self, capacity=10000):
+		if capacity < 1:
+			raise TypeError(str(capacity) + " is not a valid memo capacity")
+		self.capacity = capacity
+		self.hits = 0
+		self.misses = 0
+		self.new_chords = None
+		self.table = None
+		self._chords = collections.OrderedDict()
+
+	def __len__(self):
+		return len(self._chords)
+
+	def get_next_chord(self, current_chord, next_quality, next_root_name, key):
+		"""
+		Returns the same as get_next_chord, from the memo if possible.
+		"""
+		memo_key = (current_chord.get_voicing(), next_quality, next_root_name,
+			key)
+		next_chord = self._chords.get(memo_key)
+		if next_chord is not None:
+			self.hits += 1
+			self._chords.move_to_end(memo_key)
+			return next_chord
+
+		if self.table is not None:
+			# Hits in the shared table are not copied into the memo, or every
+			# worker would end up with its own copy of the table.
+			next_chord = self.table.get(memo_key)
+			if next_chord is not None:
+				self.hits += 1
+				return next_chord
+
+		self.misses += 1
+		next_chord = _search_next_chord(current_chord, next_quality,
+			next_root_name, key)
+		self.add(memo_key, next_chord)
+		if self.new_chords is not None:
+			self.new_chords.append((memo_key, next_chord))
+		return next_chord
+
+	def add(self, memo_key, next_chord):
+		"""
+		Adds a result to the memo, evicting the least recently used result if
+		it is full.
+		"""
+		self._chords[memo_key] = next_chord
+		if len(self._chords) > self.capacity:
+			self._chords.popitem(last=False)
+
+	def items(self):
+		"""
+		Returns a list of the (memo key, next chord) pairs in the memo.
+		"""
+		return list(self._chords.items())
+
+	def hit_rate(self):
+		"""
+		Returns the fraction of lookups found in the memo (0 if none yet).
+		"""
+		lookups = self.hits + self.misses
+		if lookups == 0:
+			return 0.0
+		return self.hits / float(lookups)
+
+	def clear(self):
+		"""
+		Empties the memo and resets its counts.
+		"""
+		self._chords.clear()
+		self.hits = 0
+		self.misses = 0
+
+# The memo that progressions are voiced with, if any (see set_next_chord_memo).
+_NEXT_CHORD_MEMO = None
+
+def set_next_chord_memo(capacity=10000):
+	"""
+	Turns on memoizing get_next_chord in get_chord_progression (and in
+	VoicingTrie) with a new NextChordMemo of the given capacity, which is
+	returned so its hit rate can be read. A capacity of None turns it off.
+	"""
+	global _NEXT_CHORD_MEMO
+	if capacity is None:
+		_NEXT_CHORD_MEMO = None
+	else:
+		_NEXT_CHORD_MEMO = NextChordMemo(capacity)
+	return _NEXT_CHORD_MEMO
+
+def _next_chord(current_chord, next_quality, next_root_name, key):
+	"""
+	Returns get_next_chord, through the memo if there is one.
+	"""
+	if _NEXT_CHORD_MEMO is None:
+		return _search_next_chord(current_chord, next_quality, next_root_name,
+			key)
+	return _NEXT_CHORD_MEMO.get_next_chord(current_chord, next_quality,
+		next_root_name, key)
+
+### Persistent tables of next chords
+
+# A NextChordMemo can be saved to and loaded from an SQLite database, so that
+# new processes start with the transitions that earlier ones worked out. The
+# database records the version of its format and a fingerprint of everything
+# the next chord depends on (the registers, the tables of chords, and the code
+# of the rules), and is ignored (and replaced when saved) if either differs.
+
+NEXT_CHORD_TABLE_VERSION = 1
+DEFAULT_NEXT_CHORD_TABLE = os.path.join(os.path.dirname(
+	os.path.abspath(__file__)), "next_chords.sqlite")
+
+def _code_fingerprint(code, digest):
+	"""
+	Adds the bytecode and constants of a code object (and the code objects
+	nested in it) to a hashlib digest.
+	"""
+	digest.update(code.co_code)
+	for constant in code.co_consts:
+		if hasattr(constant, "co_code"):
+			_code_fingerprint(constant, digest)
+		else:
+			digest.update(repr(constant).encode("utf-8"))
+
+def get_rules_fingerprint():
+	"""
+	Returns a hash of the registers, chord tables and voice leading rules,
+	which changes whenever the next chords found by get_next_chord may.
+	"""
+	import hashlib
+
+	digest = hashlib.sha1()
+	registers = [BASS_REGISTER_MIN, BASS_REGISTER_MAX, TENOR_REGISTER_MIN,
+		TENOR_REGISTER_MAX, ALTO_REGISTER_MIN, ALTO_REGISTER_MAX,
+		SOPR_REGISTER_MIN, SOPR_REGISTER_MAX]
+	digest.update(repr([str(note) for note in registers]).encode("utf-8"))
+	for table in [PITCH_MAPPING, CHORD_QUALITY_TO_STRUCTURE,
+		CHORD_QUALITY_TO_INVERSION, RULE_WEIGHTS]:
+		digest.update(repr(sorted(table.items())).encode("utf-8"))
+	digest.update(SCALE_NOTES.encode("utf-8"))
+	digest.update(repr(LEAPS_DIVISOR).encode("utf-8"))
+	# The functions get_next_chord runs, directly or not.
+	for function in [get_chord_notes, _get_registers, get_nearest_note_table,
+		_nearest_note, get_voice_intervals, has_parallels, has_voice_crossing,
+		has_octave_gap, has_doubled_leading_tone, evaluate_leaps,
+		evaluate_progression_bounded, get_register_candidates,
+		_get_next_chord_in_register, get_next_chord] + PROGRESSION_RULES:
+		_code_fingerprint(function.__code__, digest)
+	return digest.hexdigest()
+
+def _voicing_to_text(voicing):
+	return " ".join([note_name + str(octave) for note_name, octave in voicing])
+
+def _text_to_voicing(text):
+	# Octaves are a single digit (see REGISTER_MAX).
+	return tuple([(token[:-1], int(token[-1])) for token in text.split()])
+
+def _open_next_chord_table(path, read_only):
+	"""
+	Opens the database at path, returning the connection, or None if it is
+	read only and is missing or out of date.
+	"""
+	import sqlite3
+
+	if read_only:
+		if not os.path.exists(path):
+			return None
+		from urllib.request import pathname2url
+		connection = sqlite3.connect("file:" +
+			pathname2url(os.path.abspath(path)) + "?mode=ro", uri=True)
+	else:
+		connection = sqlite3.connect(path, timeout=60)
+		connection.execute("CREATE TABLE IF NOT EXISTS meta "
+			"(name TEXT PRIMARY KEY, value TEXT)")
+
+	try:
+		meta = dict(connection.execute("SELECT name, value FROM meta"))
+	except sqlite3.DatabaseError:
+		meta = {}
+	current = {"version": str(NEXT_CHORD_TABLE_VERSION),
+		"fingerprint": get_rules_fingerprint()}
+	if meta == current:
+		return connection
+
+	if read_only:
+		connection.close()
+		return None
+	with connection:
+		connection.execute("DROP TABLE IF EXISTS next_chords")
+		connection.execute("CREATE TABLE next_chords (voicing TEXT, "
+			"quality TEXT, root TEXT, key TEXT, next_voicing TEXT, "
+			"next_quality TEXT, PRIMARY KEY (voicing, quality, root, key)) "
+			"WITHOUT ROWID")
+		connection.execute("DELETE FROM meta")
+		connection.executemany("INSERT INTO meta VALUES (?, ?)",
+			current.items())
+	return connection
+
+def load_next_chord_table(memo, path=DEFAULT_NEXT_CHORD_TABLE):
+	"""
+	Fills a NextChordMemo with the next chords saved in the database at path
+	(see save_next_chord_table), which is only read, so any number of
+	processes can load it at once. Nothing is loaded if the database is
+	missing or was saved with other registers or rules. Returns the number of
+	next chords loaded.
+	"""
+	connection = _open_next_chord_table(path, True)
+	if connection is None:
+		return 0
+	try:
+		rows = connection.execute("SELECT voicing, quality, root, key, "
+			"next_voicing, next_quality FROM next_chords").fetchall()
+	finally:
+		connection.close()
+
+	for voicing, quality, root, key, next_voicing, next_quality in rows:
+		notes = [Note(note_name, octave)
+			for note_name, octave in _text_to_voicing(next_voicing)]
+		memo.add((_text_to_voicing(voicing), quality, root, key),
+			Chord(notes[0], notes[1], notes[2], notes[3], next_quality))
+	return len(rows)
+
+def save_next_chord_table(entries, path=DEFAULT_NEXT_CHORD_TABLE):
+	"""
+	Saves (memo key, next chord) pairs, such as a NextChordMemo's items() or
+	new_chords, to the database at path, creating it (or starting it again,
+	if it was saved with other registers or rules) as needed.
+	"""
+	connection = _open_next_chord_table(path, False)
+	try:
+		with connection:
+			connection.executemany("INSERT OR REPLACE INTO next_chords "
+				"VALUES (?, ?, ?, ?, ?, ?)", [(_voicing_to_text(voicing),
+				quality, root, key, _voicing_to_text(next_chord.get_voicing()),
+				next_chord.get_quality())
+				for (voicing, quality, root, key), next_chord in entries])
+	finally:
+		connection.close()
+
+### Shared tables of next chords
+
+# A table of next chords can also be packed into integer arrays in shared
+# memory (multiprocessing.shared_memory), so that worker processes read the
+# one copy made by their parent rather than each loading their own. Each
+# note is coded as the index of its name in _NOTE_NAMES times ten plus its
+# octave (9 bits), each quality and note name by its index, and a memo key
+# as the codes of the voicing, next quality, next root and key packed into
+# one 52 bit integer. The next chord is packed the same way from its voicing
+# and quality. The block holds the number of next chords, then the sorted
+# keys, then the next chords. This needs NumPy.
+
+_NOTE_NAMES = sorted(PITCH_MAPPING)
+_NOTE_NAME_CODES = dict([(note_name, index)
+	for index, note_name in enumerate(_NOTE_NAMES)])
+_QUALITIES = sorted(CHORD_QUALITY_TO_STRUCTURE)
+_QUALITY_CODES = dict([(quality, index)
+	for index, quality in enumerate(_QUALITIES)])
+
+def _pack_voicing(voicing, quality):
+	code = 0
+	for note_name, octave in voicing:
+		code = (code << 9) | (_NOTE_NAME_CODES[note_name] * 10 + octave)
+	return (code << 4) | _QUALITY_CODES[quality]
+
+def _pack_memo_key(memo_key):
+	voicing, quality, root_name, key = memo_key
+	return (((_pack_voicing(voicing, quality) << 6) |
+		_NOTE_NAME_CODES[root_name]) << 6) | _NOTE_NAME_CODES[key]
+
+def _unpack_chord(code):
+	quality = _QUALITIES[code & 15]
+	code >>= 4
+	notes = []
+	for count in range(4):
+		note_code = code & 511
+		notes.insert(0, Note(_NOTE_NAMES[note_code // 10], note_code % 10))
+		code >>= 9
+	return Chord(notes[0], notes[1], notes[2], notes[3], quality)
+
+def _attach_shared_memory(name):
+	"""
+	Attaches to the block of shared memory with the given name, made by
+	another process.
+	"""
+	from multiprocessing import shared_memory
+
+	try:
+		return shared_memory.SharedMemory(name=name, track=False)
+	except TypeError:
+		# Before Python 3.13, attaching also registers the block with the
+		# resource tracker, but the workers of a pool share the tracker of
+		# the process that made it, so it is still only freed once.
+		return shared_memory.SharedMemory(name=name)
+
+class SharedNextChordTable:
+	"""
+	A read-only table of next chords in shared memory. The parent process
+	makes it with create, passes its name to the workers, which attach to it
+	with attach, and unlinks it with close(unlink=True) once they are done.
+	get returns the next chord for a memo key of NextChordMemo, or None.
+	"""
+	def __init__(self, memory, owner):
+		import numpy
+
+		self._memory = memory
+		self._owner = owner
+		count = int(numpy.ndarray((1,), dtype=numpy.int64, buffer=memory.buf)[0])
+		# Views of the shared block: nothing is copied.
+		self._keys = numpy.ndarray((count,), dtype=numpy.int64,
+			buffer=memory.buf, offset=8)
+		self._chords = numpy.ndarray((count,), dtype=numpy.int64,
+			buffer=memory.buf, offset=8 + 8 * count)
+		self.name = memory.name
+
+	def __len__(self):
+		return len(self._keys)
+
+	@classmethod
+	def create(cls, entries):
+		"""
+		Makes a table of (memo key, next chord) pairs, such as a
+		NextChordMemo's items().
+		"""
+		import numpy
+		from multiprocessing import shared_memory
+
+		packed = sorted(set([(_pack_memo_key(memo_key), _pack_voicing(
+			next_chord.get_voicing(), next_chord.get_quality()))
+			for memo_key, next_chord in entries]))
+		count = len(packed)
+		memory = shared_memory.SharedMemory(create=True,
+			size=8 * (1 + 2 * count))
+		data = numpy.ndarray((1 + 2 * count,), dtype=numpy.int64,
+			buffer=memory.buf)
+		data[0] = count
+		if count:
+			data[1:] = numpy.array(packed, dtype=numpy.int64).T.ravel()
+		del data
+		return cls(memory, True)
+
+	@classmethod
+	def attach(cls, name):
+		"""
+		Attaches to the table made (with create) under the given name.
+		"""
+		return cls(_attach_shared_memory(name), False)
+
+	def get(self, memo_key):
+		key = _pack_memo_key(memo_key)
+		index = int(self._keys.searchsorted(key))
+		if index < len(self._keys) and self._keys[index] == key:
+			return _unpack_chord(int(self._chords[index]))
+		return None
+
+	def close(self, unlink=False):
+		"""
+		Detaches from the table, and also frees it if unlink is True (which
+		only the process that made it should do).
+		"""
+		self._keys = self._chords = None
+		self._memory.close()
+		if unlink and self._owner:
+			self._memory.unlink()
+
+### Precomputed graph of transitions between voicings
+
+# The rules in evaluate_progression only depend on the MIDI numbers of the two
+# chords and on the leading tone of the key, and get_next_chord only ever
+# considers the few candidates that get_nearest_note gives each voice. A
+# TransitionGraph works all of this out ahead of time with NumPy: the nodes
+# are all the voicings of each quality within the registers, and for each
+# pair of qualities a sparse (CSR) matrix holds the edges from each voicing to
+# the candidates get_next_chord would consider after it, in the order it
+# considers them, with their costs. The doubled leading tone rule depends on
+# the key, so each edge holds the cost of the other rules before it is
+# applied (leaps, crossing and gaps) and whether it has parallels, and the
+# cost is finished when the graph is used, adding the rules in the same order
+# as evaluate_progression so the costs (and ties) are exactly the same.
+
+def _get_structure_intervals(quality):
+	"""
+	Returns the intervals of the notes of a chord of the given quality above
+	its bass, in the order get_chord_notes spells them.
+	"""
+	chord_number = str(CHORD_QUALITY_TO_STRUCTURE[quality])
+	if len(chord_number) == 4: # For the special Dom7 Case (4710)
+		return [4, 7, 10]
+	return [int(num) for num in chord_number]
+
+def _get_candidate_patterns(quality):
+	"""
+	Returns the intervals above the bass of the tenor, alto and soprano of
+	each candidate get_next_chord makes for a chord of the given quality, in
+	the order it makes them.
+	"""
+	chord_notes = [0] + _get_structure_intervals(quality)
+	needed_chord_notes = chord_notes[1:]
+	if len(needed_chord_notes) == 3:
+		return list(itertools.permutations(needed_chord_notes))
+
+	patterns = []
+	for note in chord_notes:
+		for perm in itertools.permutations(needed_chord_notes):
+			for num in [0, 1, 2]:
+				poss = list(perm)
+				poss.insert(num, note)
+				patterns.append(tuple(poss))
+	return patterns
+
+def get_register_voicings(quality):
+	"""
+	Returns the MIDI numbers (bass, tenor, alto, soprano) of every chord of
+	the given quality, on any bass, that fits the registers of the choir, in
+	ascending order.
+	"""
+	intervals = [0] + _get_structure_intervals(quality)
+	registers = _get_registers()
+	voicings = []
+	for bass in range(registers[0][0], registers[0][1] + 1):
+		pitches = set([(bass + interval) % 12 for interval in intervals])
+		upper_voices = [[note for note in range(low, high + 1)
+			if note % 12 in pitches] for low, high in registers[1:]]
+		for tenor, alto, sopr in itertools.product(*upper_voices):
+			if set([tenor % 12, alto % 12, sopr % 12, bass % 12]) == pitches:
+				voicings.append((bass, tenor, alto, sopr))
+	return sorted(voicings)
+
+def _pack_midi_voicings(voicings):
+	# Each MIDI number fits in seven bits.
+	return (((voicings[..., 0] << 7 | voicings[..., 1]) << 7 |
+		voicings[..., 2]) << 7) | voicings[..., 3]
+
+def _nearest_midi_numbers(current, pitch, low, high):
+	"""
+	get_nearest_note for arrays of MIDI numbers: the highest of the notes
+	with the given pitch numbers in the octave below, the octave of, and the
+	octave above each current note that is within low and high.
+	"""
+	import numpy
+
+	note = (current // 12) * 12 + pitch
+	return numpy.where((note + 12 >= low) & (note + 12 <= high), note + 12,
+		numpy.where((note >= low) & (note <= high), note, note - 12))
+
+def _midi_intervals(notes1, notes2):
+	"""
+	get_interval for arrays of MIDI numbers.
+	"""
+	import numpy
+
+	difference = (numpy.maximum(notes1, notes2) % 12 -
+		numpy.minimum(notes1, notes2) % 12)
+	return numpy.where(notes1 == notes2, 0,
+		numpy.where(difference > 0, difference, difference % 12))
+
+def _transition_costs(chords1, chords2):
+	"""
+	Returns the costs of evaluate_progression for arrays of voicings (of the
+	same shape, the last axis being the voices), without the doubled leading
+	tone rule, and whether each transition has parallels.
+	"""
+	import numpy
+
+	leaps = sum([_midi_intervals(chords1[..., voice], chords2[..., voice])
+		for voice in [1, 2, 3]])
+	costs = numpy.zeros(leaps.shape) + leaps / float(LEAPS_DIVISOR)
+	bass, tenor, alto, sopr = [chords2[..., voice] for voice in range(4)]
+	costs = costs + numpy.where((bass > tenor) | (tenor > alto) | (alto > sopr),
+		RULE_WEIGHTS["voice_crossing"], 0)
+	costs = costs + numpy.where(((sopr - alto) > 12) | ((alto - tenor) > 12),
+		RULE_WEIGHTS["octave_gap"], 0)
+
+	parallels = numpy.zeros(leaps.shape, dtype=bool)
+	for index_a in range(4):
+		for index_b in range(4):
+			if index_a != index_b:
+				interval = _midi_intervals(chords1[..., index_a],
+					chords1[..., index_b])
+				parallels |= ((chords1[..., index_a] != chords1[..., index_b]) &
+					(interval == _midi_intervals(chords2[..., index_a],
+					chords2[..., index_b])) & ((interval == 7) | (interval == 0)))
+	return costs, parallels
+
+def get_model_transitions(markov_models=None):
+	"""
+	Returns the set of (quality, next quality, interval between the basses)
+	of each pair of consecutive roman numerals in the given Markov models
+	(all of MARKOV_PROGRESSION_MODELS by default).
+	"""
+	if markov_models is None:
+		markov_models = MARKOV_PROGRESSION_MODELS.values()
+	transitions = set()
+	for markov_model in markov_models:
+		for numeral, next_numerals in markov_model.items():
+			for next_numeral in next_numerals:
+				if numeral is not None and next_numeral is not None:
+					quality, bass = ROMAN_NUMERAL_TO_QUALITY[numeral]
+					next_quality, next_bass = ROMAN_NUMERAL_TO_QUALITY[next_numeral]
+					transitions.add((quality, next_quality, (next_bass - bass) % 12))
+	return transitions
+
+def get_transition_graph_fingerprint():
+	"""
+	Returns a hash of the rules (see get_rules_fingerprint) and of the code
+	that builds and reads a TransitionGraph, which changes whenever a saved
+	graph may no longer give the next chords get_next_chord does.
+	"""
+	import hashlib
+
+	digest = hashlib.sha1(get_rules_fingerprint().encode("ascii"))
+	for function in [_get_structure_intervals, _get_candidate_patterns,
+		_get_registers, get_register_voicings, _pack_midi_voicings,
+		_nearest_midi_numbers, _midi_intervals, _transition_costs,
+		TransitionGraph.build, TransitionGraph.get_next_chord]:
+		_code_fingerprint(function.__code__, digest)
+	return digest.hexdigest()
+
+# Where main saves the graph by default, next to this module.
+DEFAULT_TRANSITION_GRAPH = os.path.join(
+	os.path.dirname(os.path.abspath(__file__)), "transition_graph.npz")
+
+class TransitionGraph:
+	"""
+	A precomputed graph of the transitions between voicings that
+	get_next_chord considers (see build). get_next_chord looks the next chord
+	up in it, and falls back on the rules for transitions not in the graph.
+	Edges costing more than threshold (before the doubled leading tone rule)
+	are left out, so a lookup whose best edge costs more than threshold also
+	falls back on the rules, as the best candidate may have been left out.
+	A graph can be put in shared memory with share, for worker processes to
+	attach to (like a SharedNextChordTable), rather than each loading a copy.
+	"""
+	def __init__(self, voicings, matrices, threshold):
+		import numpy
+
+		self.threshold = threshold
+		# quality: (packed voicings, voicings, pitch numbers doubled as bits)
+		self._nodes = {}
+		for quality, quality_voicings in voicings.items():
+			doubled = numpy.zeros(len(quality_voicings), dtype=numpy.int64)
+			for pitch in range(12):
+				count = (quality_voicings % 12 == pitch).sum(axis=1)
+				doubled |= numpy.where(count > 1, 1 << pitch, 0)
+			self._nodes[quality] = (_pack_midi_voicings(quality_voicings),
+				quality_voicings, doubled)
+		# (quality, next quality): (indptr, indices, costs, parallels)
+		self._matrices = matrices
+		# The shared memory the arrays are views of, if any (see share).
+		self._memory = None
+		self._owner = False
+		self.name = None
+
+	def __len__(self):
+		return sum([len(matrix[1]) for matrix in self._matrices.values()])
+
+	@classmethod
+	def build(cls, transitions=None, threshold=1.5):
+		"""
+		Builds the graph of the given transitions (see
+		get_model_transitions, which gives the default) from every voicing of
+		each quality within the registers.
+		"""
+		import numpy
+
+		if transitions is None:
+			transitions = get_model_transitions()
+		registers = _get_registers()
+		qualities = set()
+		for quality, next_quality, interval in transitions:
+			qualities.update([quality, next_quality])
+		voicings = dict([(quality, numpy.array(get_register_voicings(quality),
+			dtype=numpy.int64)) for quality in qualities])
+		codes = dict([(quality, _pack_midi_voicings(voicings[quality]))
+			for quality in qualities])
+
+		edges = {}
+		for quality, next_quality, interval in sorted(transitions):
+			chords = voicings[quality]
+			bass = _nearest_midi_numbers(chords[:, 0],
+				(chords[:, 0] + interval) % 12, *registers[0])
+			candidates = []
+			for pattern in _get_candidate_patterns(next_quality):
+				candidate = [bass]
+				for voice, pattern_interval in enumerate(pattern):
+					candidate.append(_nearest_midi_numbers(chords[:, voice + 1],
+						(bass + pattern_interval) % 12, *registers[voice + 1]))
+				candidates.append(numpy.stack(candidate, axis=-1))
+			# candidates[row, number of the candidate, voice]
+			candidates = numpy.stack(candidates, axis=1)
+			costs, parallels = _transition_costs(chords[:, None, :], candidates)
+
+			rows = numpy.repeat(numpy.arange(len(chords)), candidates.shape[1])
+			columns = codes[next_quality].searchsorted(
+				_pack_midi_voicings(candidates).ravel())
+			costs = costs.ravel()
+			parallels = parallels.ravel()
+			kept = costs + numpy.where(parallels, RULE_WEIGHTS["parallels"],
+				0) <= threshold
+			edges.setdefault((quality, next_quality), []).append((rows[kept],
+				columns[kept], costs[kept], parallels[kept]))
+
+		matrices = {}
+		for pair, pair_edges in edges.items():
+			rows, columns, costs, parallels = [numpy.concatenate(arrays)
+				for arrays in zip(*pair_edges)]
+			# Candidates that are made more than once only count the first
+			# time, and each row is kept in the order the candidates are made.
+			first = numpy.unique(rows * len(voicings[pair[1]]) + columns,
+				return_index=True)[1]
+			first.sort()
+			order = first[numpy.argsort(rows[first], kind="stable")]
+			indptr = numpy.zeros(len(voicings[pair[0]]) + 1, dtype=numpy.int64)
+			indptr[1:] = numpy.bincount(rows[order],
+				minlength=len(voicings[pair[0]])).cumsum()
+			matrices[pair] = (indptr, columns[order], costs[order],
+				parallels[order])
+
+		return cls(voicings, matrices, threshold)
+
+	def save(self, npzfile):
+		"""
+		Saves the graph to a NumPy .npz file (a path or a binary file object),
+		with the fingerprint of the rules and code it was built with (see
+		get_transition_graph_fingerprint).
+		"""
+		import numpy
+
+		arrays = self._get_arrays()
+		arrays["fingerprint"] = numpy.array(get_transition_graph_fingerprint())
+		arrays["threshold"] = numpy.array(self.threshold)
+		numpy.savez(npzfile, **arrays)
+
+	@classmethod
+	def load(cls, path):
+		"""
+		Loads a graph saved with save, or returns None if it is missing or was
+		built with other registers, rules or code.
+		"""
+		import numpy
+
+		if not os.path.exists(path):
+			return None
+		with numpy.load(path) as npzfile:
+			if (str(npzfile["fingerprint"]) !=
+				get_transition_graph_fingerprint()):
+				return None
+			arrays = dict([(name, npzfile[name]) for name in npzfile.files
+				if "/" in name])
+			threshold = float(npzfile["threshold"])
+		return cls._from_arrays(arrays, threshold)
+
+	def _get_arrays(self):
+		"""
+		Returns the arrays of the graph by name: "voicings/<quality>" and
+		"<array>/<quality>/<next quality>" for each array of each matrix.
+		"""
+		arrays = {}
+		for quality, (codes, voicings, doubled) in self._nodes.items():
+			arrays["voicings/" + quality] = voicings
+		for (quality, next_quality), matrix in self._matrices.items():
+			for name, array in zip(["indptr", "indices", "costs", "parallels"],
+				matrix):
+				arrays[name + "/" + quality + "/" + next_quality] = array
+		return arrays
+
+	@classmethod
+	def _from_arrays(cls, arrays, threshold):
+		voicings = {}
+		parts = {}
+		for name, array in arrays.items():
+			if name.startswith("voicings/"):
+				voicings[name.split("/")[1]] = array
+			else:
+				part, quality, next_quality = name.split("/")
+				parts.setdefault((quality, next_quality), {})[part] = array
+		matrices = dict([(pair, (part["indptr"], part["indices"], part["costs"],
+			part["parallels"])) for pair, part in parts.items()])
+		return cls(voicings, matrices, threshold)
+
+	def share(self):
+		"""
+		Copies the graph to a new block of shared memory, returning the graph
+		there. Worker processes attach to it by its name, with attach, and
+		the process that shared it frees it with close(unlink=True) once they
+		are done.
+		"""
+		import json
+		import numpy
+		from multiprocessing import shared_memory
+
+		arrays = self._get_arrays()
+		# The block starts with the length of a JSON header, which gives the
+		# threshold and the dtype, shape and offset of each array. Each array
+		# starts on a multiple of 8 bytes.
+		directory = []
+		size = 0
+		for name in sorted(arrays):
+			array = arrays[name]
+			directory.append([name, array.dtype.str, list(array.shape), size])
+			size += (array.nbytes + 7) // 8 * 8
+		header = json.dumps({"threshold": self.threshold,
+			"arrays": directory}).encode("utf-8")
+		start = 8 + (len(header) + 7) // 8 * 8
+		memory = shared_memory.SharedMemory(create=True, size=start + size)
+		try:
+			memory.buf[:8] = numpy.int64(len(header)).tobytes()
+			memory.buf[8:8 + len(header)] = header
+			for name, dtype, shape, offset in directory:
+				view = numpy.ndarray(shape, dtype=dtype, buffer=memory.buf,
+					offset=start + offset)
+				view[...] = arrays[name]
+				del view
+			return type(self)._from_memory(memory, True)
+		except BaseException:
+			memory.close()
+			memory.unlink()
+			raise
+
+	@classmethod
+	def attach(cls, name):
+		"""
+		Attaches to the graph shared (with share) under the given name.
+		"""
+		return cls._from_memory(_attach_shared_memory(name), False)
+
+	@classmethod
+	def _from_memory(cls, memory, owner):
+		import json
+		import numpy
+
+		length = int(numpy.ndarray((1,), dtype=numpy.int64, buffer=memory.buf)[0])
+		header = json.loads(bytes(memory.buf[8:8 + length]).decode("utf-8"))
+		start = 8 + (length + 7) // 8 * 8
+		# Views of the shared block: nothing is copied.
+		arrays = dict([(name, numpy.ndarray(shape, dtype=dtype,
+			buffer=memory.buf, offset=start + offset))
+			for name, dtype, shape, offset in header["arrays"]])
+		graph = cls._from_arrays(arrays, header["threshold"])
+		graph._memory = memory
+		graph._owner = owner
+		graph.name = memory.name
+		return graph
+
+	def close(self, unlink=False):
+		"""
+		Detaches a shared graph, and also frees it if unlink is True (which
+		only the process that shared it should do). The graph cannot be used
+		afterwards.
+		"""
+		self._nodes = {}
+		self._matrices = {}
+		if self._memory is not None:
+			self._memory.close()
+			if unlink and self._owner:
+				self._memory.unlink()
+			self._memory = None
+
+	def get_next_chord(self, current_chord, next_quality, next_root_name, key):
+		"""
+		Returns the same as get_next_chord, from the graph if possible.
+		"""
+		import numpy
+
+		quality = current_chord.get_quality()
+		matrix = self._matrices.get((quality, next_quality))
+		if matrix is not None:
+			codes = self._nodes[quality][0]
+			notes = current_chord.get_midi_numbers()
+			code = ((notes[0] << 7 | notes[1]) << 7 | notes[2]) << 7 | notes[3]
+			row = int(codes.searchsorted(code))
+			if row < len(codes) and codes[row] == code:
+				indptr, indices, costs, parallels = matrix
+				start, end = indptr[row], indptr[row + 1]
+				columns = indices[start:end]
+				next_codes, next_voicings, doubled = self._nodes[next_quality]
+				low, high = _get_registers()[0]
+				next_bass = int(_nearest_midi_numbers(numpy.int64(notes[0]),
+					PITCH_MAPPING[next_root_name], low, high))
+				edges = next_voicings[columns, 0] == next_bass
+				if edges.any():
+					columns = columns[edges]
+					leading_tone_num = (PITCH_MAPPING[key] - 1) % 12
+					# The rules are added in the order of evaluate_progression.
+					total = costs[start:end][edges] + numpy.where(
+						(doubled[columns] >> leading_tone_num) & 1,
+						RULE_WEIGHTS["doubled_leading_tone"], 0)
+					total = total + numpy.where(parallels[start:end][edges],
+						RULE_WEIGHTS["parallels"], 0)
+					best = int(total.argmin())
+					if total[best] <= self.threshold:
+						next_chord = _spell_chord(
+							next_voicings[columns[best]].tolist(), next_quality,
+							next_root_name)
+						if next_chord is not None:
+							return next_chord
+
+		return get_next_chord(current_chord, next_quality, next_root_name, key)
+
+# The graph that next chords are looked up in, if any (see
+# set_transition_graph).
+_TRANSITION_GRAPH = None
+
+def set_transition_graph(graph):
+	"""
+	Turns on looking next chords up in the given TransitionGraph in
+	get_chord_progression (and in NextChordMemo and VoicingTrie), in place of
+	running the rules on every candidate. A graph of None turns it off.
+	"""
+	global _TRANSITION_GRAPH
+	_TRANSITION_GRAPH = graph
+	return _TRANSITION_GRAPH
+
+def _search_next_chord(current_chord, next_quality, next_root_name, key):
+	"""
+	Returns get_next_chord, through the graph if there is one.
+	"""
+	if _TRANSITION_GRAPH is None:
+		return get_next_chord(current_chord, next_quality, next_root_name, key)
+	return _TRANSITION_GRAPH.get_next_chord(current_chord, next_quality,
+		next_root_name, key)
+
 ROMAN_NUMERAL_TO_QUALITY = {"I": ("Maj", 0), "I6": ("Maj6", 4), "I64": ("Maj64", 7),
 "i": ("Min", 0), "i6": ("Min6", 3), "i64": ("Min64", 7), "ii": ("Min", 2),
 "ii6": ("Min6", 5), "ii64": ("Min64", 9), "iidim": ("Dim", 2), "iidim6": ("Dim6", 5), 
@@ -610,12 +1680,10 @@ def get_first_chord(key, is_major):
 	chord_notes = get_chord_notes(qual, Note(key, 2))
 
 	bass = Note(key, 3)
-	tenor = get_nearest_note(Note("Bb", 3), chord_notes[2], 
-		TENOR_REGISTER_MIN, TENOR_REGISTER_MAX)		
-	alto = get_nearest_note(Note("F", 4), chord_notes[1], 
-		ALTO_REGISTER_MIN, ALTO_REGISTER_MAX)
-	sopr = get_nearest_note(Note("B", 4), chord_notes[0], 
-		SOPR_REGISTER_MIN, SOPR_REGISTER_MAX)
+	# Starting from Bb3, F4 and B4.
+	tenor = _nearest_note(58, chord_notes[2], 1)
+	alto = _nearest_note(65, chord_notes[1], 2)
+	sopr = _nearest_note(71, chord_notes[0], 3)
 
 	return Chord(bass, tenor, alto, sopr, qual)
 
@@ -636,23 +1704,214 @@ def get_root_name(roman_numeral, key):
 			if keya[0] == note_letter:
 				return keya
 
-def get_chord_progression(progression, key, is_major):
+def get_chord_progression(progression, key, is_major, full_register=False):
 	"""
 	Given a list of chords in roman numeral form, returns
-	a list of chords that fit the progression. is_major is a boolean
+	a list of chords that fit the progression. is_major is a boolean.
+	full_register is passed on to get_next_chord (the memo and transition
+	graph only hold next chords found without it, so it skips them).
 	"""
 	chords = []
 	last_chord = get_first_chord(key, is_major)
 	chords.append(last_chord)
 
 	for numeral in progression[1:]:
-		last_chord = get_next_chord(last_chord,
-			ROMAN_NUMERAL_TO_QUALITY[numeral][0],
-			get_root_name(numeral, key), key)
+		if full_register:
+			last_chord = get_next_chord(last_chord,
+				ROMAN_NUMERAL_TO_QUALITY[numeral][0],
+				get_root_name(numeral, key), key, full_register=True)
+		else:
+			last_chord = _next_chord(last_chord,
+				ROMAN_NUMERAL_TO_QUALITY[numeral][0],
+				get_root_name(numeral, key), key)
 		chords.append(last_chord)
 
 	return chords
 
+class _TrieNode:
+	"""
+	A node of a VoicingTrie: the chord voiced for the prefix that leads to
+	it, and the nodes of the prefixes one numeral longer.
+	"""
+	__slots__ = ("parent", "label", "chord", "children")
+
+	def __init__(self, parent, label, chord):
+		self.parent = parent
+		self.label = label
+		self.chord = chord
+		self.children = {}
+
+class VoicingTrie:
+	"""
+	A cache of voiced progressions for batch generation. The voicing of each
+	chord of a progression only depends on the key and the chords before it,
+	and random progressions mostly share their first few numerals, so the
+	chords are kept in a trie: the roots are keyed by key and mode (they hold
+	the first chord), and the children of a node by the next numeral. Only
+	the numerals past the longest prefix already in the trie are voiced.
+
+	At most max_nodes chords are kept. Each progression looked up marks the
+	nodes on its path as used, from the last chord back to the first, so a
+	node is always more recently used than its children, and evicting the
+	least recently used nodes prunes cold subtrees from their leaves up.
+	"""
+	def __init__(self, max_nodes=20000):
+		if max_nodes < 1:
+			raise TypeError(str(max_nodes) + " is not a valid trie size")
+		self.max_nodes = max_nodes
+		self.hits = 0
+		self.misses = 0
+		self._roots = {}
+		# The nodes, least recently used first.
+		self._nodes = collections.OrderedDict()
+
+	def __len__(self):
+		return len(self._nodes)
+
+	def _add_node(self, parent, label, chord):
+		"""
+		Adds a node for the given chord under parent (None for a root).
+		"""
+		node = _TrieNode(parent, label, chord)
+		if parent is None:
+			self._roots[label] = node
+		else:
+			parent.children[label] = node
+		self._nodes[node] = None
+		self.misses += 1
+		return node
+
+	def get_chord_progression(self, progression, key, is_major):
+		"""
+		Returns the same as get_chord_progression (the chords are shared with
+		the trie, but chords are never changed once made).
+		"""
+		node = self._roots.get((key, is_major))
+		if node is None:
+			node = self._add_node(None, (key, is_major),
+				get_first_chord(key, is_major))
+		else:
+			self.hits += 1
+		path = [node]
+
+		for numeral in progression[1:]:
+			child = node.children.get(numeral)
+			if child is None:
+				child = self._add_node(node, numeral, _next_chord(node.chord,
+					ROMAN_NUMERAL_TO_QUALITY[numeral][0],
+					get_root_name(numeral, key), key))
+			else:
+				self.hits += 1
+			node = child
+			path.append(node)
+
+		for node in reversed(path):
+			self._nodes.move_to_end(node)
+		while len(self._nodes) > self.max_nodes:
+			node = self._nodes.popitem(last=False)[0]
+			if node.parent is None:
+				del self._roots[node.label]
+			else:
+				del node.parent.children[node.label]
+
+		return [node.chord for node in path]
+
+# The trie that get_transposed_chord_progression voices progressions with.
+_VOICING_TRIE = VoicingTrie()
+
+# The voice leading of a progression is the same in every key, up to register
+# and spelling, so get_transposed_chord_progression transposes one voicing to
+# several keys. The search favours the top of each voice's register, so
+# transposing a voicing down by up to a major third always stays in range,
+# while transposing it up seldom does. Each key is therefore transposed down
+# from the nearest of TRANSPOSITION_REFERENCE_KEYS at or above it (its
+# transposition class), whose voicing is searched for once and kept in
+# _TRANSPOSED_VOICINGS, keyed by the roman numerals, mode and reference key,
+# as the quality and MIDI numbers of each chord.
+TRANSPOSITION_REFERENCE_KEYS = ["D", "E", "A"]
+# The voicings of progressions in the reference keys, keyed by (numerals,
+# is_major, reference key), evicting the least recently used past
+# TRANSPOSED_VOICINGS_CAPACITY.
+TRANSPOSED_VOICINGS_CAPACITY = 10000
+_TRANSPOSED_VOICINGS = collections.OrderedDict()
+
+def _spell_chord(midi_numbers, quality, bass_name):
+	"""
+	Given the MIDI numbers of the notes of a chord (bass first), its quality
+	and the name of its bass note, returns the chord with its notes spelled
+	as in get_chord_notes, or None if it is out of range for a 4-part choir.
+	"""
+	note_names = {}
+	for note_name in get_chord_notes(quality, Note(bass_name, 4)):
+		note_names[PITCH_MAPPING[note_name]] = note_name
+
+	notes = []
+	for midi_number in midi_numbers:
+		note_name = note_names[midi_number % 12]
+		octave = (midi_number - PITCH_MAPPING[note_name]) // 12 - 1
+		if (octave < REGISTER_MIN) or (octave > REGISTER_MAX):
+			return None
+		notes.append(Note(note_name, octave))
+
+	try:
+		return Chord(notes[0], notes[1], notes[2], notes[3], quality)
+	except TypeError:
+		return None
+
+def get_transposition_reference(key):
+	"""
+	Returns the key of TRANSPOSITION_REFERENCE_KEYS nearest above (or equal
+	to) the given key, and the number of semitones down from it to the key.
+	"""
+	intervals = []
+	for reference_key in TRANSPOSITION_REFERENCE_KEYS:
+		intervals.append(((PITCH_MAPPING[reference_key] - PITCH_MAPPING[key])
+			% 12, reference_key))
+	interval, reference_key = min(intervals)
+	return reference_key, interval
+
+def get_transposed_chord_progression(progression, key, is_major):
+	"""
+	Returns a voicing of the progression in the given key that approximates
+	get_chord_progression: the voicing get_chord_progression finds in the
+	key's transposition reference (see get_transposition_reference),
+	transposed down to the key, so the progression is searched for at most
+	once for every few keys. Only in the reference keys themselves is it the
+	same as get_chord_progression; in the others the voices usually differ,
+	as the search depends on the registers. If the transposed voicing doesn't
+	fit the choir's registers, the progression is searched for in the key
+	itself. The result only depends on the progression and key, whatever is
+	cached. Searches go through a VoicingTrie, so they only voice the
+	numerals past the longest prefix voiced before.
+	"""
+	reference_key, interval = get_transposition_reference(key)
+	cache_key = (tuple(progression), is_major, reference_key)
+	voicing = _TRANSPOSED_VOICINGS.get(cache_key)
+	if voicing is None:
+		voicing = [(chord.get_quality(), chord.get_midi_numbers()) for chord in
+			_VOICING_TRIE.get_chord_progression(progression, reference_key,
+			is_major)]
+		_TRANSPOSED_VOICINGS[cache_key] = voicing
+		if len(_TRANSPOSED_VOICINGS) > TRANSPOSED_VOICINGS_CAPACITY:
+			_TRANSPOSED_VOICINGS.popitem(last=False)
+	else:
+		_TRANSPOSED_VOICINGS.move_to_end(cache_key)
+
+	# The first chord is built on the key itself (see get_first_chord).
+	bass_names = [key] + [get_root_name(numeral, key)
+		for numeral in progression[1:]]
+
+	chords = []
+	for (quality, midi_numbers), bass_name in zip(voicing, bass_names):
+		chord = _spell_chord([midi_number - interval
+			for midi_number in midi_numbers], quality, bass_name)
+		if chord is None:
+			return _VOICING_TRIE.get_chord_progression(progression, key,
+				is_major)
+		chords.append(chord)
+
+	return chords
+
 # MAYBE TWEAK SO THAT GET_NEXT_CHORD TAKES PROGRESSION INSTEAD OF
 # CURRENT_CHORD, AND CHECKS FOR TOO MUCH PARALLELS
 # ALSO, ADD EVALUATION TO MAKE HALF STEP MOTION MORE COMMON. MAYBE IN
@@ -660,81 +1919,228 @@ def get_chord_progression(progression, key, is_major):
 
 ### Export as a midi using midiutil
 
-from midiutil.MidiFile3 import MIDIFile
-
-def create_midi_from_progression(progression):
+# midiutil is imported by the functions that need it, when a MIDI file is
+# first exported, so that importing this module for voice leading alone
+# doesn't load it.
+
+# Each layout gives the names of the tracks of the MIDI file, and the tracks
+# that each voice (bass, tenor, alto, soprano) is written to. More layouts
+# can be added here, e.g. one track per voice plus a piano reduction:
+# (["Soprano", "Alto", "Tenor", "Bass", "Piano"], [[3, 4], [2, 4], [1, 4], [0, 4]])
+MIDI_LAYOUTS = {"individual_voices": (["Soprano", "Alto", "Tenor", "Bass"],
+	[[3], [2], [1], [0]]),
+"two_hands": (["Upper Voices", "Lower Voices"], [[1], [1], [0], [0]])}
+
+# Just intonation ratios of the notes of each kind of chord to its root,
+# keyed by the interval above the root. The dominant seventh is tuned as the
+# harmonic seventh (7:4).
+JUST_INTONATION_RATIOS = {"Maj": {0: 1.0, 4: 5.0 / 4, 7: 3.0 / 2},
+"Min": {0: 1.0, 3: 6.0 / 5, 7: 3.0 / 2},
+"Aug": {0: 1.0, 4: 5.0 / 4, 8: 25.0 / 16},
+"Dim": {0: 1.0, 3: 6.0 / 5, 6: 64.0 / 45},
+"Dom": {0: 1.0, 4: 5.0 / 4, 7: 3.0 / 2, 10: 7.0 / 4}}
+
+_JUST_TUNING_TABLES = {}
+
+# The position of each natural major key on the circle of fifths, which is
+# the number of sharps (or minus the number of flats) in its key signature.
+# Each sharp in the key name adds seven, each flat takes away seven, and the
+# relative minor is three steps flatwards.
+KEY_LETTER_TO_FIFTHS = {"F": -1, "C": 0, "G": 1, "D": 2, "A": 3, "E": 4,
+"B": 5}
+
+def get_key_signature(key, is_major):
+	"""
+	Given a key (as in get_chord_progression, e.g. "Bb") and whether it is
+	major, returns the number of sharps in its key signature, where a negative
+	number is a number of flats.
+	"""
+	_check_valid_note(key)
+	accidentals = (KEY_LETTER_TO_FIFTHS[key[0]] + 7 * key.count("#")
+		- 7 * key.count("b"))
+	if not is_major:
+		accidentals -= 3
+	if accidentals < -7 or accidentals > 7:
+		raise TypeError(str(key) + " has no key signature")
+	return accidentals
+
+def get_just_tuning_table(root_number, quality):
+	"""
+	Returns a dictionary from the MIDI number of every note of the chord
+	with the given root (a pitch number) and quality, within the range of
+	the choir, to its encoded note tuning (see encodeNoteTunings in
+	midiutil). The notes are tuned in just intonation against the equal
+	tempered root. A progression only uses a handful of (root, quality)
+	pairs, so the tables are built once and cached.
+	"""
+	key = (root_number, quality[:3])
+	if key not in _JUST_TUNING_TABLES:
+		from midiutil.MidiFile3 import encodeNoteTunings
+
+		ratios = JUST_INTONATION_RATIOS[quality[:3]]
+		tunings = []
+		for midi_number in range(BASS_REGISTER_MIN.get_midi_number(),
+			SOPR_REGISTER_MAX.get_midi_number() + 1):
+			interval = (midi_number - root_number) % 12
+			if interval in ratios:
+				root_midi_number = midi_number - interval
+				frequency = 440 * 2 ** ((root_midi_number - 69) / 12.0)
+				tunings.append((midi_number, frequency * ratios[interval]))
+
+		# All of the frequencies are transformed in one call.
+		encoded = encodeNoteTunings(tunings)
+		table = {}
+		for index, (midi_number, frequency) in enumerate(tunings):
+			table[midi_number] = encoded[4 * index:4 * index + 4]
+		_JUST_TUNING_TABLES[key] = table
+
+	return _JUST_TUNING_TABLES[key]
+
+def get_note_columns(progression):
 	"""
 	Given a chord progression in the form of a list of chord instances,
-	creates a MIDI file as an output.
-	"""
-	MyMIDI = MIDIFile(4)
-	track = 0
-	time = 0
-	MyMIDI.addTrackName(track, time, "Soprano")
-	MyMIDI.addTempo(track, time, 60)
-	track += 1
-	MyMIDI.addTrackName(track, time, "Alto")
-	MyMIDI.addTempo(track, time, 60)
-	track += 1
-	MyMIDI.addTrackName(track, time, "Tenor")
-	MyMIDI.addTempo(track, time, 60)
-	track += 1
-	MyMIDI.addTrackName(track, time, "Bass")
-	MyMIDI.addTempo(track, time, 60)
+	returns the start times and durations of the chords (in beats), the
+	MIDI numbers of each voice and the harmony of each chord, as
+	(times, durations, pitches, harmonies), where pitches is a list of four
+	lists, bass first, and harmonies is a list of (root number, quality)
+	pairs. Every layout is built from these, so the progression only has
+	to be walked once per export.
+	"""
+	times = list(range(len(progression)))
+	# The last chord is held for two beats.
+	durations = [1] * len(progression)
+	if len(progression) > 1:
+		durations[-1] = 2
+
+	pitches = [[], [], [], []]
+	harmonies = []
+	for chord in progression:
+		for voice, pitch in enumerate(chord.get_midi_numbers()):
+			pitches[voice].append(pitch)
+		harmonies.append((chord.get_root_number(), chord.get_quality()))
+
+	return times, durations, pitches, harmonies
+
+def _build_midi(columns, layout, just_intonation=False, key=None,
+	is_major=True):
+	"""
+	Builds a MIDIFile of the given note columns in the given layout.
+	With just_intonation, each chord is preceded by a note tuning message
+	(in the first track) tuning its notes in just intonation. The first
+	track also carries the time signature (4/4) and, if a key is given, the
+	key signature.
+	"""
+	if layout not in MIDI_LAYOUTS:
+		raise TypeError(str(layout) + " is not a valid MIDI layout")
+	track_names, voice_tracks = MIDI_LAYOUTS[layout]
+	times, durations, pitches, harmonies = columns
+
+	from midiutil.MidiFile3 import MIDIFile, MAJOR, MINOR
+
+	MyMIDI = MIDIFile(len(track_names))
+	for track, track_name in enumerate(track_names):
+		MyMIDI.setTrackPrelude(track, track_name, 60)
+
+	MyMIDI.addTimeSignature(0, 0, 4, 4)
+	if key is not None:
+		if is_major:
+			mode = MAJOR
+		else:
+			mode = MINOR
+		MyMIDI.addKeySignature(0, 0, get_key_signature(key, is_major), mode)
 
 	channel = 0
-	duration = 1
 	volume = 100
 
-	for index, chord in enumerate(progression):
-		track = 3
-		for note in chord.get_notes():
-			pitch = note.get_midi_number()
-			MyMIDI.addNote(track, channel, pitch, time, duration, volume)
-			track -= 1
-		time += 1
-		if index == len(progression) - 2:
-			duration = 2
-	binfile = open("output_individual_voices.mid", 'wb')
-	MyMIDI.writeFile(binfile)
-	binfile.close()
-
-
-	MyMIDI = MIDIFile(2)
-	track = 0
-	time = 0
-	MyMIDI.addTrackName(track, time, "Upper Voices")
-	MyMIDI.addTempo(track, time, 60)
-	track += 1
-	MyMIDI.addTrackName(track, time, "Lower Voices")
-	MyMIDI.addTempo(track, time, 60)
-
-	duration = 1
-
-	for index, chord in enumerate(progression):
-		track = 1
-		count = 0
-		for note in chord.get_notes():
-			pitch = note.get_midi_number()
-			MyMIDI.addNote(track, channel, pitch, time, duration, volume)
-			if count % 2 == 1:
-				track -= 1
-			count += 1
-		time += 1
-		if index == len(progression) - 2:
-			duration = 2
-	binfile = open("output_two_hands.mid", 'wb')
-	MyMIDI.writeFile(binfile)
-	binfile.close()
+	for voice_pitches, tracks in zip(pitches, voice_tracks):
+		for track in tracks:
+			for pitch, note_time, duration in zip(voice_pitches, times,
+				durations):
+				MyMIDI.addNote(track, channel, pitch, note_time, duration,
+					volume)
+
+	if just_intonation:
+		for chord_time, (root_number, quality), chord_pitches in zip(times,
+			harmonies, zip(*pitches)):
+			table = get_just_tuning_table(root_number, quality)
+			chord_pitches = sorted(set(chord_pitches))
+			# Tuning program 0, then the tunings of the notes.
+			payload = bytes([0, len(chord_pitches)]) + b"".join(
+				[table[pitch] for pitch in chord_pitches])
+			MyMIDI.addUniversalSysEx(0, chord_time, 8, 2, payload, realTime=True)
+
+	return MyMIDI
+
+def write_midi_from_progression(progression, layout, binfile,
+	just_intonation=False, key=None, is_major=True):
+	"""
+	Given a chord progression in the form of a list of chord instances,
+	writes it as a MIDI file to binfile, which can be any file-like object
+	opened for binary writing (a file, a BytesIO, a socket's makefile("wb")).
+	layout is one of MIDI_LAYOUTS: "individual_voices" gives each voice its
+	own track, and "two_hands" splits the voices into upper and lower tracks.
+	If just_intonation is True, each chord is retuned in just intonation
+	relative to its root (with MIDI tuning standard messages). If the key
+	and mode (is_major) of the progression are given, as passed to
+	get_chord_progression, the file carries its key signature.
+	"""
+	_build_midi(get_note_columns(progression), layout,
+		just_intonation, key, is_major).writeFile(binfile)
+
+def get_midi_from_progression(progression, layout, just_intonation=False,
+	key=None, is_major=True):
+	"""
+	Given a chord progression in the form of a list of chord instances,
+	returns the bytes of a MIDI file of it in the given layout (see
+	write_midi_from_progression).
+	"""
+	return get_midis_from_progression(progression, [layout],
+		just_intonation, key, is_major)[layout]
+
+def get_midis_from_progression(progression, layouts=None,
+	just_intonation=False, key=None, is_major=True):
+	"""
+	Given a chord progression in the form of a list of chord instances,
+	returns a dictionary of the bytes of a MIDI file of it in each of the
+	given layouts (all of MIDI_LAYOUTS by default). The notes are only
+	gathered once, so each extra layout only costs its encoding.
+	"""
+	if layouts is None:
+		layouts = MIDI_LAYOUTS.keys()
+	columns = get_note_columns(progression)
+
+	midis = {}
+	for layout in layouts:
+		binfile = io.BytesIO()
+		_build_midi(columns, layout, just_intonation, key,
+			is_major).writeFile(binfile)
+		midis[layout] = binfile.getvalue()
+	return midis
+
+def create_midi_from_progression(progression, key=None, is_major=True):
+	"""
+	Given a chord progression in the form of a list of chord instances,
+	creates a MIDI file as an output, in each of the layouts.
+	The files are written to the current directory as output_<layout>.mid,
+	e.g. output_individual_voices.mid and output_two_hands.mid.
+	key and is_major are those the progression was made with (see
+	get_chord_progression); if the key is given, it is written to the files
+	as their key signature.
+	"""
+	for layout, midi in get_midis_from_progression(progression, key=key,
+		is_major=is_major).items():
+		binfile = open("output_" + layout + ".mid", 'wb')
+		binfile.write(midi)
+		binfile.close()
 
 # chords = get_chord_progression(["I", "viidim6", "I6", "vi", "ii", "IV6", "ii6", "IV", "V42", "I6", "V", "vi", "ii", "IV", "I64", "V7", "I"], "C", True)
 # chords = get_chord_progression(["I", "IV6", "I6", "ii6", "V65", "vi", "ii6", "I64", "V7", "I"], "F", True)
 
 # count = 1
 # for chord in chords:
-#  	print "Chord:", count
-#  	print chord
-#  	print
+#  	print("Chord:", count)
+#  	print(chord)
+#  	print()
 #  	count += 1
 
 # create_midi_from_progression(chords)
@@ -742,14 +2148,15 @@ def create_midi_from_progression(progression):
 ### Generate a random sequence of Chords given a first order markov
 ### model representation of chord progressions
 
-def next_state(markov_model, current_state):
+def next_state(markov_model, current_state, rng=random):
     """
     Given a markov chain and the current state, randomly chooses
-    the next state based upon the markov chain.
+    the next state based upon the markov chain. rng is the source of
+    randomness (a random.Random), by default the random module.
     """
     if markov_model:
         if current_state in markov_model:
-            rand = random.random()
+            rand = rng.random()
             for key, value in markov_model[current_state].items():
                 if value > rand:
                     return key
@@ -783,20 +2190,31 @@ MAJOR_MARKOV_PROGRESSION_MODEL = {None: {"I": 1},
 "viidim": {"iii": .4, "I6": .2, "V": .4},
 "viidim6": {"I": .3, "I6": .6, "iii6": .1}}
 
+# The models of progressions in each mode that can be generated.
+MARKOV_PROGRESSION_MODELS = {"major": MAJOR_MARKOV_PROGRESSION_MODEL}
+
+def get_random_progression(markov_model, rng=random):
+	"""
+	Given a markov chain, returns a random progression of roman numerals
+	from it, from its start (the None state) until it returns to None.
+	"""
+	progression = [next_state(markov_model, None, rng)]
+	while (progression[-1] != None):
+		progression.append(next_state(markov_model, progression[-1], rng))
+	progression.pop()
+	return progression
+
 def run(is_major=True):
 	"""
 	Runs a markov model of a harmonic progression. Currently only does major.
+	Importing the module has no side effects; see main for the command line.
 	"""
 	### Randomly choose the chord qualities
 	if is_major:
 		markov = MAJOR_MARKOV_PROGRESSION_MODEL
-	progression = [next_state(markov, None)]
-	# count = 0
-	while (progression[-1] != None):
-		progression.append(next_state(markov, progression[-1]))
-		print progression[-1]
-		# count += 1
-	progression.pop()
+	progression = get_random_progression(markov)
+	for numeral in progression[1:]:
+		print(numeral)
 
 	### Randomly choose a key
 
@@ -809,7 +2227,191 @@ def run(is_major=True):
 
 	### Generate the MIDI files
 
-	create_midi_from_progression(chords)
+	create_midi_from_progression(chords, key, is_major)
 
+def _write_atomically(path, data):
+	"""
+	Writes data to the file at path by writing a temporary file next to it
+	and renaming it into place, so the file is never seen half written.
+	"""
+	import tempfile
+
+	directory, name = os.path.split(path)
+	handle, temp_path = tempfile.mkstemp(prefix="." + name + ".", dir=directory)
+	try:
+		# mkstemp makes the file readable by its owner only; give it the
+		# permissions open would have.
+		umask = os.umask(0)
+		os.umask(umask)
+		os.fchmod(handle, 0o666 & ~umask)
+		with os.fdopen(handle, "wb") as binfile:
+			binfile.write(data)
+		os.replace(temp_path, path)
+	except BaseException:
+		os.remove(temp_path)
+		raise
+
+def generate_chorale(job):
+	"""
+	Generates one chorale and writes it to a MIDI file in each of the given
+	layouts. job is a tuple of (output directory, key, mode, seed, index,
+	layouts, full_register), where mode is one of MARKOV_PROGRESSION_MODELS
+	and full_register is passed on to get_chord_progression. The progression
+	is drawn from a random.Random seeded with the seed and index, so each
+	chorale is the same whichever process makes it. Returns the paths of the
+	files written.
+	"""
+	output, key, mode, seed, index, layouts, full_register = job
+	rng = random.Random(str(seed) + ":" + str(index))
+	is_major = mode == "major"
+	progression = get_random_progression(MARKOV_PROGRESSION_MODELS[mode], rng)
+	if full_register:
+		chords = get_chord_progression(progression, key, is_major,
+			full_register=True)
+	else:
+		# A seed and index give the same progression in every key, so a
+		# process making it in several keys can transpose it rather than
+		# search again.
+		chords = get_transposed_chord_progression(progression, key, is_major)
+
+	paths = []
+	name = "chorale_" + key + "_" + mode + "_" + str(seed) + "_" + str(index)
+	for layout, midi in get_midis_from_progression(chords, layouts,
+		key=key, is_major=is_major).items():
+		path = os.path.join(output, name + "_" + layout + ".mid")
+		_write_atomically(path, midi)
+		paths.append(path)
+	return paths
+
+def _start_worker(table_name, graph_name=None):
+	"""
+	Starts a worker process of main with a memo of get_next_chord that reads
+	the shared table of next chords with the given name (if any), and records
+	the next chords it adds, and with the shared transition graph with the
+	given name (if any).
+	"""
+	if graph_name is not None:
+		set_transition_graph(TransitionGraph.attach(graph_name))
+	if table_name is None:
+		return
+	memo = set_next_chord_memo(1000000)
+	memo.table = SharedNextChordTable.attach(table_name)
+	memo.new_chords = []
+
+def _generate_chorale_in_worker(job):
+	"""
+	Runs generate_chorale in a worker started by _start_worker, returning the
+	paths written and the next chords found since the last job.
+	"""
+	paths = generate_chorale(job)
+	new_chords = _NEXT_CHORD_MEMO.new_chords
+	_NEXT_CHORD_MEMO.new_chords = []
+	return paths, new_chords
 
-run()
+def main(args=None):
+	"""
+	Generates a batch of chorales from the command line, e.g.
+	python voiceleading.py --count 100 --keys C G F --seeds 1 2 --output out
+	makes 100 chorales in each key for each seed (600 in all), in parallel
+	across a pool of worker processes.
+	"""
+	import argparse
+	import concurrent.futures
+
+	parser = argparse.ArgumentParser(
+		description="Generate four-part chorales as MIDI files.")
+	parser.add_argument("--count", type=int, default=1,
+		help="chorales to make for each key and seed (default 1)")
+	parser.add_argument("--keys", nargs="+", default=["C"],
+		help="keys to make chorales in (default C)")
+	parser.add_argument("--mode", choices=sorted(MARKOV_PROGRESSION_MODELS),
+		default="major", help="mode of the chorales (default major)")
+	parser.add_argument("--seeds", nargs="+", type=int, default=[0],
+		help="random seeds, each of which makes its own batch (default 0)")
+	parser.add_argument("--layouts", nargs="+", choices=sorted(MIDI_LAYOUTS),
+		default=sorted(MIDI_LAYOUTS), help="MIDI layouts to write (default all)")
+	parser.add_argument("--output", default=".",
+		help="directory to write the MIDI files to (default .)")
+	parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+		help="worker processes (default one per CPU)")
+	parser.add_argument("--cache", nargs="?", const=DEFAULT_NEXT_CHORD_TABLE,
+		help="a table of next chords to start the workers with, and to save "
+		"the new ones to (default " + os.path.basename(DEFAULT_NEXT_CHORD_TABLE)
+		+ " next to this module)")
+	parser.add_argument("--graph", nargs="?", const=DEFAULT_TRANSITION_GRAPH,
+		help="a transition graph to look next chords up in, built first if "
+		"it is missing or out of date (default "
+		+ os.path.basename(DEFAULT_TRANSITION_GRAPH) + " next to this module)")
+	parser.add_argument("--full-register", action="store_true",
+		help="consider every voicing within the registers for each chord, "
+		"rather than the nearest note in each voice (--cache and --graph "
+		"do not apply)")
+	args = parser.parse_args(args)
+
+	for key in args.keys:
+		try:
+			get_key_signature(key, args.mode == "major")
+		except TypeError as error:
+			parser.error(str(error))
+	if not os.path.isdir(args.output):
+		os.makedirs(args.output)
+	# The graph is loaded (or built) once, here, and shared with the workers.
+	graph = None
+	graph_name = None
+	if args.graph is not None:
+		graph = TransitionGraph.load(args.graph)
+		if graph is None:
+			graph = TransitionGraph.build()
+			buffer = io.BytesIO()
+			graph.save(buffer)
+			_write_atomically(args.graph, buffer.getvalue())
+		graph = graph.share()
+		graph_name = graph.name
+
+	jobs = [(args.output, key, args.mode, seed, index, args.layouts,
+		args.full_register)
+		for seed in args.seeds for key in args.keys
+		for index in range(args.count)]
+
+	start = time.time()
+	files = 0
+	workers = args.workers or 1
+	# Jobs are handed out in chunks, as each one is only a few milliseconds.
+	chunksize = max(1, len(jobs) // (4 * workers))
+	try:
+		if args.cache is None:
+			with concurrent.futures.ProcessPoolExecutor(workers,
+				initializer=_start_worker,
+				initargs=(None, graph_name)) as executor:
+				for paths in executor.map(generate_chorale, jobs,
+					chunksize=chunksize):
+					files += len(paths)
+		else:
+			# The table is loaded once, here, and shared with the workers,
+			# which only read it. The next chords they add are saved once they
+			# are done.
+			memo = NextChordMemo(1000000)
+			load_next_chord_table(memo, args.cache)
+			table = SharedNextChordTable.create(memo.items())
+			new_chords = []
+			try:
+				with concurrent.futures.ProcessPoolExecutor(workers,
+					initializer=_start_worker,
+					initargs=(table.name, graph_name)) as executor:
+					for paths, chords in executor.map(
+						_generate_chorale_in_worker, jobs, chunksize=chunksize):
+						files += len(paths)
+						new_chords.extend(chords)
+			finally:
+				table.close(unlink=True)
+			save_next_chord_table(new_chords, args.cache)
+	finally:
+		if graph is not None:
+			graph.close(unlink=True)
+	elapsed = time.time() - start
+
+	print("Wrote %d chorales (%d files) to %s in %.2f s (%.1f chorales/sec)" %
+		(len(jobs), files, args.output, elapsed, len(jobs) / max(elapsed, 1e-9)))
+
+if __name__ == "__main__":
+	main()